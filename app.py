@@ -16,7 +16,6 @@ from sklearn.ensemble import HistGradientBoostingClassifier, VotingRegressor
 from sklearn.feature_selection import (
     RFECV,
     SelectFromModel,
-    SelectKBest,
     SequentialFeatureSelector,
     f_classif,
 )
@@ -26,16 +25,12 @@ from sklearn.metrics import (
     ConfusionMatrixDisplay,
     DetCurveDisplay,
     PrecisionRecallDisplay,
-    precision_recall_curve,
     RocCurveDisplay,
-    classification_report,
-    make_scorer,
 )
 from sklearn.model_selection import (
     GridSearchCV,
     KFold,
     cross_validate,
-    train_test_split,
     cross_val_score,
     check_cv,
 )
@@ -52,12 +47,51 @@ from sklearn.preprocessing import (
 from sklearn.svm import LinearSVC
 import streamlit as st
 from sklearn.decomposition import TruncatedSVD
-from sklearn.metrics import confusion_matrix, mean_squared_error, r2_score
+from sklearn.metrics import mean_squared_error, r2_score
 import seaborn as sns
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.tree import DecisionTreeClassifier
 
 import os
+import time
+from itertools import combinations
+from concurrent.futures import CancelledError
+
+from loan_data import DATA_CACHE, load_loans, split_loans
+from features import (
+    ONEHOT_STORE,
+    ChunkedPolynomialFeatures,
+    OneHotBlockEncoder,
+    PairInteractions,
+    SelectUpToKBest,
+    ensure_onehot_store,
+)
+from scoring import (
+    REFIT_METRIC,
+    confusion_counts,
+    custom_prof_score,
+    loan_scorer,
+    prof_score,
+    report_from_counts,
+    threshold_sweep,
+)
+from search import (
+    BACKENDS,
+    BudgetedSearch,
+    HalvingSearch,
+    PipelineCache,
+    WorkerBudget,
+    fit_search,
+    planned_fits,
+    serial_time_estimate,
+)
+from experiment_cache import ResultStore, config_key, data_fingerprint, pipeline_params
+from jobs import JobCancelled, JobRunner
+from oof_store import OOFRecorder
+from holdout import evaluate_holdout
+from artifacts import load_artifact, save_artifact
+from path_search import KNN_INDEXES, PathSearch
+from cost_estimate import estimate_cost, fit_seconds, format_bytes, largest_fitting_degree, limit_problems
 
 
 ################################ formatting #############################
@@ -102,52 +136,49 @@ with st.sidebar:
 
 # load data
 
-loans = pd.read_csv("inputs/final_2013_subsample.csv")
-
-# drop some bad columns here, or in the pipeline
-loans = loans.drop("id", axis = 1)
-
-# loans = loans.drop(
-#     ["member_id", "id", "desc", "earliest_cr_line", "emp_title", "issue_d"], axis=1
-# )
-
-# create holdout sample
-
-y = loans.loan_status == "Charged Off"
-y.value_counts()
-loans = loans.drop("loan_status", axis=1)
-
-
-X_train, X_test, y_train, y_test = train_test_split(
-    loans, y, stratify=y, test_size=0.2, random_state=0
-)  # (stratify will make sure that test/train both have equal fractions of outcome)
-
-# define the profit function
-def custom_prof_score(y, y_pred, roa=0.02, haircut=0.20):
-    """
-    Firm profit is this times the average loan size. We can
-    ignore that term for the purposes of maximization. 
-    """
-    TN = sum((y_pred == 0) & (y == 0))  # count loans made and actually paid back
-    FN = sum((y_pred == 0) & (y == 1))  # count loans made and actually defaulting
-    return TN * roa - FN * haircut
-
+# parsing the csv on every rerun was the slowest part of the app, so the data is
+# converted once to a columnar file (see loan_data.py) and the split is shared
+# by every session in this process
+@st.cache_resource
+def load_split():
+    loans = load_loans()
+    # one-hot encode every categorical column once, see features.py
+    ensure_onehot_store(loans.drop("loan_status", axis=1), source=DATA_CACHE)
+    return split_loans(loans)
 
-# so that we can use the fcn in sklearn, "make a scorer" out of that function
-
-prof_score = make_scorer(custom_prof_score)
+X_train, X_test, y_train, y_test = load_split()
 
 # list of all num vars:
 num_pipe_features = X_train.select_dtypes(include="float64").columns
 
 # List of all categorical variables
-cat_pipe_features = X_train.select_dtypes(include='object').columns  # all: X_train.select_dtypes(include='object').columns
+cat_pipe_features = X_train.select_dtypes(include=['object', 'category']).columns  # all: X_train.select_dtypes(include='object').columns
 
 def load_leaderboard():
     if os.path.exists('leaderboard.csv'):
         return pd.read_csv('leaderboard.csv')
     else:
-        return pd.DataFrame(columns=['User Name', 'Model Name', 'Numerical Features', 'Categorical Features', 'Feature Selection Method', 'Feature Creation Method', 'F1-score'])
+        return pd.DataFrame(columns=['User Name', 'Model Name', 'Numerical Features', 'Categorical Features', 'Feature Selection Method', 'Feature Creation Method', 'F1-score',
+                                     'Test F1', 'Test Profit', 'Artifact'])
+
+# one worker budget for the whole server, see search.py
+@st.cache_resource
+def get_worker_budget():
+    return WorkerBudget()
+
+# finished searches, keyed on their configuration and this fingerprint of the data
+@st.cache_resource
+def get_data_fingerprint():
+    return data_fingerprint(X_train, y_train)
+
+@st.cache_resource
+def get_result_store():
+    return ResultStore()
+
+# fits run here in the background instead of inside the script run
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
 
 # Load the leaderboard at the start of the app
 if 'leaderboard' not in st.session_state:
@@ -156,7 +187,8 @@ if 'leaderboard' not in st.session_state:
 ################################################## custom model code #################################################
 
 # Function to create a pipeline based on user-selected model and features
-def create_pipeline(model_name, feature_select, feature_create, num_pipe_features, cat_pipe_features, degree = None):
+def create_pipeline(model_name, feature_select, feature_create, num_pipe_features, cat_pipe_features, degree = None, memory = None, onehot_store = None,
+                    interaction_pairs = None, numeric_scaler = None):
     if model_name == 'Logistic Regression':
         clf = LogisticRegression(class_weight='balanced', penalty='l2')
     elif model_name == 'Linear SVC':
@@ -169,24 +201,42 @@ def create_pipeline(model_name, feature_select, feature_create, num_pipe_feature
     # Preprocessing pipelines for numerical and categorical features
     numer_pipe = make_pipeline(SimpleImputer(strategy="mean"), StandardScaler())
 
-    cat_pipe = make_pipeline(OneHotEncoder(handle_unknown='ignore'))
+    # Sparse Interactions creates features inside the column transformer, so the
+    # scalers only ever see the dense numeric block and the one-hot block stays sparse
+    sparse_create = feature_create == 'Sparse Interactions'
+    if sparse_create and numeric_scaler == 'MinMaxScaler':
+        numer_pipe.steps.append(('minmaxscaler', MinMaxScaler()))
+    elif sparse_create and numeric_scaler == 'MaxAbsScaler':
+        numer_pipe.steps.append(('maxabsscaler', MaxAbsScaler()))
+
+    # with a block store the categoricals are sliced from precomputed one-hot blocks
+    if onehot_store is not None:
+        cat_pipe = make_pipeline(OneHotBlockEncoder(onehot_store))
+    else:
+        cat_pipe = make_pipeline(OneHotEncoder(handle_unknown='ignore'))
     
     # Preprocessing pipeline for the entire dataset
     # didn't use make_column_transformer; wanted to name steps
+    transformers = [(numer_pipe, num_pipe_features), (cat_pipe, cat_pipe_features)]
+    if sparse_create and interaction_pairs:
+        pair_columns = sorted({col for pair in interaction_pairs for col in pair})
+        transformers.append((PairInteractions(pairs=interaction_pairs), pair_columns))
+
     preproc_pipe = make_column_transformer(
-    (numer_pipe, num_pipe_features), 
-    (cat_pipe, cat_pipe_features), 
+    *transformers, 
     remainder="drop",
+    sparse_threshold=1.0 if sparse_create else 0.3,  # 1.0: stay sparse whenever any block is
     )
 
 # Define the feature selection transformer based on the selected method
     if feature_select == 'passthrough':
         feature_selector = 'passthrough'
     elif feature_select.startswith('PCA'):
-        n_components = int(feature_select.split('(')[1].split(')')[0])
+        # 'PCA' from the menu carries no count; the grid sets n_components
+        n_components = int(feature_select.split('(')[1].split(')')[0]) if '(' in feature_select else 2
         feature_selector = TruncatedSVD(n_components=n_components)
     elif feature_select.startswith('SelectKBest'):
-        feature_selector = SelectKBest(score_func=f_classif)
+        feature_selector = SelectUpToKBest(score_func=f_classif)
     elif feature_select.startswith('SelectFromModel'):
         if 'LinearSVC' in feature_select:
             class_weight = st.selectbox("Select class weight for LinearSVC", ['balanced', None])
@@ -215,18 +265,29 @@ def create_pipeline(model_name, feature_select, feature_create, num_pipe_feature
         feature_creator = 'passthrough'
     elif feature_create.startswith('PolynomialFeatures'):
         interaction_only = 'interaction_only' in feature_create
-        feature_creator = PolynomialFeatures(degree=degree, interaction_only=interaction_only)
+        if 'Chunked' in feature_create:
+            # built in row chunks into a memory-mapped file instead of all at once in memory
+            feature_creator = ChunkedPolynomialFeatures(degree=degree, interaction_only=interaction_only)
+        else:
+            feature_creator = PolynomialFeatures(degree=degree, interaction_only=interaction_only)
     elif feature_create == 'MinMaxScaler':
         feature_creator = MinMaxScaler()
     elif feature_create == 'MaxAbsScaler':
         feature_creator = MaxAbsScaler()
+    elif feature_create == 'Sparse Interactions':
+        feature_creator = 'passthrough'  # already done in the column transformer
         
+    # the chunked features are a memory-mapped file; the step cache would pickle
+    # the whole matrix per fold and load it back into RAM on a hit
+    if isinstance(feature_creator, ChunkedPolynomialFeatures):
+        memory = None
+
     # I used "Pipeline" not "make_pipeline" bc I wanted to name the steps
     pipe = Pipeline([('columntransformer',preproc_pipe),
                  ('feature_create', feature_creator), 
                  ('feature_select', feature_selector), 
                  ('clf', clf)
-                ])
+                ], memory=memory)  # memory caches the fitted preprocessing per fold, see PipelineCache
 
     return pipe
 
@@ -317,12 +378,21 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
     feature_select_method = st.selectbox("Choose Feature Selection Method:", feature_select_options, key='selected_feature_selection')
     
     # Dropdown menu to choose the feature creation method
-    feature_create_options = ['passthrough', 'PolynomialFeatures', 'MinMaxScaler', 'MaxAbsScaler']
+    feature_create_options = ['passthrough', 'PolynomialFeatures', 'PolynomialFeatures (Chunked, on disk)', 'MinMaxScaler', 'MaxAbsScaler', 'Sparse Interactions']
     feature_create_method = st.selectbox("Choose Feature Creation Method:", feature_create_options, key='selected_feature_creation')
+
+    # Sparse Interactions: scale only the numeric features and interact only the chosen pairs
+    interaction_pairs = []
+    numeric_scaler = None
+    if feature_create_method == 'Sparse Interactions':
+        numeric_scaler = st.selectbox("Extra scaling for the numerical features", ['None', 'MinMaxScaler', 'MaxAbsScaler'])
+        pair_options = {f"{a} x {b}": (a, b) for a, b in combinations(list(selected_num_features) + list(selected_cat_features), 2)}
+        selected_pairs = st.multiselect("Select Feature Pairs to Interact:", list(pair_options), key='selected_interaction_pairs')
+        interaction_pairs = [pair_options[pair] for pair in selected_pairs]
     
     # If PolynomialFeatures is selected, provide an input field to specify the degree
-    if feature_create_method == 'PolynomialFeatures':
-        degree = st.number_input("Enter the degree for PolynomialFeatures", min_value=1, max_value=5, value=2)
+    if feature_create_method.startswith('PolynomialFeatures'):
+        degree = st.number_input("Enter the degree for PolynomialFeatures", min_value=1, max_value=5, value=2, key='poly_degree')
     else:
         degree = None
 
@@ -340,6 +410,15 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
         min_split_min = st.slider('Min Samples Split - Min Value', min_value=2, max_value=50, value=2)
         min_split_max = st.slider('Min Samples Split - Max Value', min_value=2, max_value=50, value=10)
         hyperparameter_ranges['min_samples_split'] = list(range(min_split_min, min_split_max + 1))
+        # optional: tune depth and cost-complexity pruning too (cheap under Shared-Path Evaluation)
+        if st.checkbox('Also tune Max Depth'):
+            depth_min = st.slider('Max Depth - Min Value', min_value=1, max_value=30, value=3)
+            depth_max = st.slider('Max Depth - Max Value', min_value=1, max_value=30, value=10)
+            hyperparameter_ranges['max_depth'] = list(range(depth_min, depth_max + 1))
+        if st.checkbox('Also tune Cost-Complexity Pruning (ccp_alpha)'):
+            alpha_min = st.number_input('ccp_alpha - Min Value', min_value=0.0, max_value=0.1, value=0.0, step=0.0001, format="%.4f")
+            alpha_max = st.number_input('ccp_alpha - Max Value', min_value=0.0, max_value=0.1, value=0.001, step=0.0001, format="%.4f")
+            hyperparameter_ranges['ccp_alpha'] = np.linspace(alpha_min, alpha_max, num=5)
         
     if feature_select_method in ['SelectKBest(f_classif)']:
         selectkbest_k_min = st.slider('SelectKBest - Min K', min_value=1, max_value=50, value=5)
@@ -362,17 +441,38 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
         step_min = st.slider('RFECV Step - Min Value', min_value=1, max_value=10, value=1)
         step_max = st.slider('RFECV Step - Max Value', min_value=1, max_value=10, value=5)
         hyperparameter_ranges['step'] = np.arange(step_min, step_max + 1)
-    else:
-        hyperparameter_ranges = None
+    # passthrough has no selection hyperparameters; the model's ranges above still apply
     
     # Create the pipeline based on the selected model and features
-    pipe = create_pipeline(model_name, feature_select_method, feature_create_method, selected_num_features, selected_cat_features, degree)
+    pipeline_cache = PipelineCache()
+    pipe = create_pipeline(model_name, feature_select_method, feature_create_method, selected_num_features, selected_cat_features, degree, memory=pipeline_cache, onehot_store=ONEHOT_STORE,
+                           interaction_pairs=interaction_pairs, numeric_scaler=numeric_scaler)
     
     # Dropdown menu to choose the cross-validation strategy
     num_folds = st.number_input("Enter the number of folds for cross-validation", min_value=2, max_value=10, value=5)
 
     # Define your cross-validation strategy based on the user input
     cv = KFold(n_splits=num_folds, shuffle=True, random_state=42)
+
+    # Parallel execution: workers come out of a budget shared by every session on the server
+    worker_budget = get_worker_budget()
+    n_jobs = st.slider('Number of Parallel Workers', min_value=1, max_value=worker_budget.total, value=1, key='selected_workers')
+    backend_name = st.selectbox("Parallel Backend:", list(BACKENDS), key='selected_backend')
+
+    # Search strategy: the full grid, or successive halving on growing stratified subsamples
+    search_options = ['Exhaustive Grid Search', 'Shared-Path Evaluation', 'Successive Halving', 'Time-Budgeted Random Search', 'Time-Budgeted Model-Based Search']
+    search_strategy = st.selectbox("Choose Search Strategy:", search_options, key='selected_search')
+    search_settings = {'strategy': search_strategy}
+    if search_strategy == 'Successive Halving':
+        search_settings['factor'] = st.slider('Halving Factor (keep the best 1/factor each round)', min_value=2, max_value=5, value=3)
+        search_settings['min_resources'] = st.number_input("Minimum rows in the first round", min_value=500, max_value=50000, value=2000, step=500,
+                                                         help="The last round uses every row and each earlier one 1/factor of the next, so the first round gets between this and factor times this many rows.")
+    elif search_strategy == 'Shared-Path Evaluation' and model_name == 'K-Nearest Neighbors':
+        search_settings['knn_index'] = st.selectbox("Neighbor index (built once per fold)", KNN_INDEXES)
+    elif search_strategy.startswith('Time-Budgeted'):
+        search_settings['time_budget'] = st.slider('Time Budget (seconds)', min_value=10, max_value=1800, value=120, step=10)
+        max_candidates = st.number_input("Maximum number of candidates (0 = as many as the grid has points)", min_value=0, max_value=1000, value=0)
+        search_settings['max_candidates'] = max_candidates or None
     
     # end: user choices
     ##################################################
@@ -404,6 +504,10 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
             param_grid['clf__n_neighbors'] = hyperparameter_ranges['n_neighbors']
         elif model == 'Decision Tree':
             param_grid['clf__min_samples_split'] = hyperparameter_ranges['min_samples_split']
+            if 'max_depth' in hyperparameter_ranges:
+                param_grid['clf__max_depth'] = hyperparameter_ranges['max_depth']
+            if 'ccp_alpha' in hyperparameter_ranges:
+                param_grid['clf__ccp_alpha'] = hyperparameter_ranges['ccp_alpha']
         
         return param_grid
     
@@ -413,32 +517,192 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
 
     st.write(param_grid)
     
-    grid_search = GridSearchCV(estimator = pipe, 
-                           param_grid = param_grid,
-                           cv = cv,
-                           scoring= prof_score, 
-                           error_score="raise",
-                           )
-
-    # Fit the grid search to your data
-    try:
-        results = grid_search.fit(X_train, y_train)
-    except Exception as e:
-        # Report the resulting error traceback
-        st.write("An error occurred during grid search fitting:")
-        st.write(e)
-        
+    if search_strategy == 'Successive Halving':
+        grid_search = HalvingSearch(estimator = pipe,
+                                    param_grid = param_grid,
+                                    cv = cv,
+                                    scoring = loan_scorer,
+                                    refit = REFIT_METRIC,
+                                    factor = search_settings['factor'],
+                                    min_resources = search_settings['min_resources'],
+                                    )
+    elif search_strategy == 'Shared-Path Evaluation':
+        grid_search = PathSearch(estimator = pipe,
+                                 param_grid = param_grid,
+                                 cv = cv,
+                                 refit = REFIT_METRIC,
+                                 knn_index = search_settings.get('knn_index', 'brute'),
+                                 )
+    elif search_strategy.startswith('Time-Budgeted'):
+        grid_search = BudgetedSearch(estimator = pipe,
+                                     param_grid = param_grid,
+                                     cv = cv,
+                                     scoring = loan_scorer,
+                                     refit = REFIT_METRIC,
+                                     method = 'model' if 'Model-Based' in search_strategy else 'random',
+                                     time_budget = search_settings['time_budget'],
+                                     max_candidates = search_settings['max_candidates'],
+                                     )
+    else:
+        grid_search = GridSearchCV(estimator = pipe, 
+                               param_grid = param_grid,
+                               cv = cv,
+                               scoring= loan_scorer, 
+                               refit= REFIT_METRIC,
+                               error_score="raise",
+                               )
+
+    # What the search will cost, before anything is fitted (see cost_estimate.py)
+    cost = estimate_cost(grid_search, X_train, n_jobs)
+    fit_counts = cost['fits']
+    matrix_text = f"{format_bytes(cost['sparse_bytes'])} sparse" if cost['sparse'] else f"{format_bytes(cost['dense_bytes'])} dense"
+    st.info(f"{cost['n_features']:,} features after preprocessing: a {matrix_text} design matrix per worker "
+            f"(dense: {format_bytes(cost['dense_bytes'])}, sparse: {format_bytes(cost['sparse_bytes'])}). "
+            f"This search runs up to {fit_counts['total']:,} model fits: "
+            f"{fit_counts['scored']:,} scored candidate fits and {fit_counts['selector']:,} fits inside the feature selector.")
+    if cost['disk_bytes']:
+        st.caption(f"The polynomial features are written to disk in chunks: about {format_bytes(cost['disk_bytes'])} of temporary files, "
+                   f"{format_bytes(cost['peak_bytes'])} in memory.")
+    selector_heavy = fit_counts['selector'] > fit_counts['scored'] and search_strategy != 'Shared-Path Evaluation'
+    if selector_heavy:
+        st.caption("The feature selector runs its own cross-validation for every candidate. "
+                   "Shared-Path Evaluation runs it once per fold and setting and reuses it across the model's hyperparameters.")
+
+    # Over the server's limits: refuse to run, and offer the nearest configuration that is not
+    def set_widget(key, value):
+        st.session_state[key] = value
+
+    def offer_downgrades(problems):
+        st.error("This configuration is over the server's limits and will not be run. " + " ".join(problems))
+        fitting_degree = largest_fitting_degree(pipe, X_train, n_jobs)
+        if fitting_degree is not None:
+            st.button(f"Use PolynomialFeatures degree {fitting_degree}", on_click=set_widget, args=('poly_degree', fitting_degree))
+        if feature_create_method == 'PolynomialFeatures':
+            st.button("Build the polynomial features on disk instead", on_click=set_widget,
+                      args=('selected_feature_creation', 'PolynomialFeatures (Chunked, on disk)'))
+        if n_jobs > 1:
+            st.button("Use 1 worker (one design matrix in memory)", on_click=set_widget, args=('selected_workers', 1))
+        if selector_heavy:
+            st.button("Use Shared-Path Evaluation", on_click=set_widget, args=('selected_search', 'Shared-Path Evaluation'))
+        elif search_strategy in ['Exhaustive Grid Search', 'Shared-Path Evaluation']:
+            st.button("Use Successive Halving", on_click=set_widget, args=('selected_search', 'Successive Halving'))
+
+    cost_problems = limit_problems(cost)
+    if cost_problems:
+        offer_downgrades(cost_problems)
+
+    # A configuration someone already ran is served from the result store
+    experiment_config = {
+        'model': model_name,
+        'numerical_features': list(selected_num_features),
+        'categorical_features': list(selected_cat_features),
+        'feature_select': feature_select_method,
+        'feature_create': feature_create_method,
+        'degree': degree,
+        'interaction_pairs': interaction_pairs,
+        'numeric_scaler': numeric_scaler,
+        'num_folds': num_folds,
+        'param_grid': param_grid,
+        'search': search_settings,
+        'pipeline_params': pipeline_params(pipe),
+    }
+    result_key = config_key(experiment_config, get_data_fingerprint())
+    result_store = get_result_store()
+
+    # Nothing is fitted until the user asks for it; the fit then runs as a background job
+    if st.button('Run Model', disabled=bool(cost_problems)):
+        results = result_store.get(result_key)
+        if results is not None:
+            st.info("This configuration was run before; showing the stored results.")
+            st.session_state['search_result'] = results
+            st.session_state['search_config'] = experiment_config
+        elif st.session_state.get('fit_job') is not None:
+            st.warning("A model is already being fitted for you; cancel it first to start another.")
+        else:
+            try:
+                with st.spinner("Timing a small fit to estimate the run time..."):
+                    seconds = fit_seconds(grid_search, X_train, y_train, cost, n_jobs)
+            except Exception as e:
+                # an invalid configuration already fails on the timing fit; nothing was started
+                st.error(f"A test fit of this configuration failed, so it was not run: {e}")
+            else:
+                time_problems = limit_problems(cost, seconds)
+                if time_problems:
+                    offer_downgrades(time_problems)
+                else:
+                    def fit_job(job):
+                        # every candidate's out-of-fold scores are kept until the best one is known
+                        oof = OOFRecorder(os.path.join(job.dir, 'oof'))
+                        if isinstance(grid_search, PathSearch):
+                            grid_search.set_params(progress=job.reporter(), oof=oof)
+                        else:
+                            grid_search.set_params(scoring=job.wrap_scoring(oof.scorer(list(param_grid))))
+                        results = fit_search(grid_search, X_train, y_train, worker_budget, n_jobs, BACKENDS[backend_name], pipeline_cache, oof=oof)
+                        # the test split is only ever scored here, once, by the chosen model
+                        results.diagnostics['holdout'] = evaluate_holdout(results.best_estimator_, X_test, y_test, n_jobs=n_jobs, trace_memory=False)
+                        result_store.put(result_key, results)
+                        return results
+
+                    total_fits = planned_fits(grid_search, len(y_train))
+                    st.session_state['fit_job'] = get_job_runner().submit(total_fits, fit_job, config=experiment_config)
+
+    job = st.session_state.get('fit_job')
+    if job is not None and job.running():
+        done = job.done_count()
+        eta = job.eta()
+        eta_text = "estimating time left" if eta is None else f"about {eta:.0f}s left"
+        if done == job.total:
+            eta_text = "refitting the best candidate"
+        st.progress(done / job.total, text=f"{done}/{job.total} candidate fits done, {eta_text}")
+        if st.button('Cancel'):
+            job.cancel()
+        # poll until the job finishes
+        time.sleep(1)
+        st.rerun()
+    elif job is not None:
+        # the job finished: attach its results to this session
+        del st.session_state['fit_job']
+        try:
+            st.session_state['search_result'] = job.result()
+            st.session_state['search_config'] = job.config
+        except (JobCancelled, CancelledError):
+            st.warning("Model fitting was cancelled.")
+        except Exception as e:
+            # Report the resulting error traceback
+            st.write("An error occurred during grid search fitting:")
+            st.write(e)
+        finally:
+            job.cleanup()
+
+    if 'search_result' not in st.session_state:
+        st.stop()
+    results = st.session_state['search_result']
+    run_config = st.session_state['search_config']
+
     st.write("\n" * 5)
     st.markdown("<h1 style='text-align: center;'>Ranking CV Test Scores by Mean and STD </h1>", unsafe_allow_html=True)
     output_df = pd.DataFrame(results.cv_results_).set_index('params').fillna('')
-    st.write(output_df)
+
+    # Show the speedup of the parallel run next to the results table
+    serial_time = serial_time_estimate(results.cv_results_)
+    table_col, speed_col = st.columns([5, 1])
+    with table_col:
+        st.write(output_df)
+    with speed_col:
+        st.metric("Workers", results.info['workers'])
+        st.metric("Wall Time (s)", f"{results.info['wall_time']:.1f}")
+        st.metric("Speedup vs 1 Core", f"{serial_time / results.info['wall_time']:.1f}x")
+        st.metric("Preprocessing Cache Hits", results.info['cache_hits'])
+        st.metric("Preprocessing Cache Misses", results.info['cache_misses'])
+        if 'compute_fraction' in results.info:
+            st.metric("Compute Saved vs Full Grid", f"{1 - results.info['compute_fraction']:.0%}")
 
     # Create a new figure and axis object using Matplotlib's object-oriented interface
     fig, ax = plt.subplots()
     
     # Plot the scatter plot
-    scatter = ax.scatter(output_df['std_test_score'], output_df['mean_test_score'], color='blue')
-    ax.scatter(output_df['std_test_score'][0], output_df['mean_test_score'][0], color='red')
+    scatter = ax.scatter(output_df['std_test_profit'], output_df['mean_test_profit'], color='blue')
+    ax.scatter(output_df['std_test_profit'].iloc[0], output_df['mean_test_profit'].iloc[0], color='red')
     
     # Set the plot title and labels
     ax.set_title("Mean vs STD of CV Test Scores")
@@ -448,14 +712,36 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
     # Show the plot
     st.pyplot(fig)
 
+    # Budgeted searches: best profit found so far against elapsed time
+    if 'trace' in results.info:
+        elapsed, best_profit = zip(*results.info['trace'])
+        fig, ax = plt.subplots()
+        ax.step(elapsed, best_profit, where='post')
+        ax.scatter(elapsed, best_profit, color='blue', s=10)
+        ax.set_title("Best Profit Score vs Elapsed Time")
+        ax.set_ylabel("Best Mean Test Profit")
+        ax.set_xlabel("Elapsed Time (s)")
+        st.write("\n" * 5)
+        st.markdown("<h1 style='text-align: center;'>Search Convergence</h1>", unsafe_allow_html=True)
+        st.pyplot(fig)
+
 
-    # Get the best estimator and predictions
+    # Every diagnostic below comes from the best candidate's out-of-fold predictions,
+    # stored by the search (see oof_store.py); nothing is predicted again on the training set
     best_estimator = results.best_estimator_
-    y_pred_train = results.predict(X_train)
+    has_oof = 'oof_pred' in results.diagnostics
+    if not has_oof:
+        st.info("These stored results predate the out-of-fold diagnostics; run the model again to see them.")
+        st.session_state['model_F1score'] = results.cv_results_['mean_test_f1'][results.best_index_]
+
+    if has_oof and run_config['model'] in ["Logistic Regression", "Linear SVC", "K-Nearest Neighbors", "Decision Tree"]:
+        oof_pred = results.diagnostics['oof_pred']
+        oof_scores = results.diagnostics['oof_scores']
+        scored = oof_pred >= 0  # every row, unless the search left some unscored
+        tn, fp, fn, tp = confusion_counts(y_train[scored], oof_pred[scored])
 
-    if model_name in ["Logistic Regression", "Linear SVC", "K-Nearest Neighbors", "Decision Tree"]:
         # Calculate classification report
-        report = classification_report(y_train, y_pred_train, output_dict=True)
+        report = report_from_counts(tn, fp, fn, tp)
         
         # Create a formatted classification report string
         # classification_report_str = """
@@ -469,7 +755,8 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
       #             report["True"]["precision"], report["True"]["recall"], report["True"]["f1-score"], report["True"]["support"],
        #            report["accuracy"])
         
-        F1score = report['True']['f1-score']
+        # leaderboard F1: the F1 of the pooled out-of-fold predictions
+        F1score = report["True"]["f1-score"]
         st.session_state['model_F1score'] = F1score
     
 
@@ -513,27 +800,48 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
         st.markdown("<h1 style='text-align: center;'>Classification Report</h1>", unsafe_allow_html=True)
         st.markdown(classification_report_str, unsafe_allow_html=True)
 
-        # Assuming y_train and y_pred_train are true and predicted labels for the training set
-        precision, recall, _ = precision_recall_curve(y_train, y_pred_train)
-        
-        # Create a new figure
+        # Precision, recall and profit at every cutoff of the best model's out-of-fold
+        # scores: no refit, and a real curve instead of the three points hard labels give
+        default_cutoff = results.diagnostics['oof_threshold']
+
+        roa_col, haircut_col = st.columns(2)
+        with roa_col:
+            roa = st.number_input("Return on a repaid loan (roa)", min_value=0.0, max_value=1.0, value=0.02, step=0.01)
+        with haircut_col:
+            haircut = st.number_input("Loss on a defaulted loan (haircut)", min_value=0.0, max_value=1.0, value=0.20, step=0.01)
+        sweep = threshold_sweep(y_train, oof_scores, roa=roa, haircut=haircut)
+        best = int(np.argmax(sweep['profit']))
+        default_profit = custom_prof_score(y_train[scored], oof_scores[scored] > default_cutoff, roa=roa, haircut=haircut)
+
+        st.write("\n" * 5)
+        st.markdown("<h1 style='text-align: center;'>Decision Threshold</h1>", unsafe_allow_html=True)
+        cutoff_col, profit_col, default_col = st.columns(3)
+        cutoff_col.metric("Profit-Maximizing Cutoff", f"{sweep['threshold'][best]:.4f}")
+        profit_col.metric("Out-of-Fold Profit at That Cutoff", f"{sweep['profit'][best]:,.1f}")
+        default_col.metric(f"Profit at the Default Cutoff ({default_cutoff:g})", f"{default_profit:,.1f}")
+
         fig, ax = plt.subplots()
-        
-        # Plot the Precision-Recall curve
-        ax.plot(recall, precision)
-        
-        # Set labels and title
+        finite = np.isfinite(sweep['threshold'])
+        ax.plot(sweep['threshold'][finite], sweep['profit'][finite])
+        ax.axvline(sweep['threshold'][best], color='red', linestyle='--')
+        ax.set_xlabel('Cutoff (loans scored above it are flagged as defaults)')
+        ax.set_ylabel('Profit')
+        ax.set_title('Profit vs Decision Cutoff')
+        st.pyplot(fig)
+
+        fig, ax = plt.subplots()
+        ax.plot(sweep['recall'], sweep['precision'])
+        ax.scatter(sweep['recall'][best], sweep['precision'][best], color='red')
         ax.set_xlabel('Recall')
         ax.set_ylabel('Precision')
         ax.set_title('Precision-Recall Curve')
-        
-        # Display the plot in Streamlit
+
         st.write("\n" * 5)
         st.markdown("<h1 style='text-align: center;'>Precision Recall</h1>", unsafe_allow_html=True)
         st.pyplot(fig)
         
-        # Calculate confusion matrix
-        cm = confusion_matrix(y_train, y_pred_train)
+        # Confusion matrix: the same counts the report came from
+        cm = np.array([[tn, fp], [fn, tp]])
         
         # Display confusion matrix
         st.write("\n" * 5)
@@ -541,17 +849,36 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
         confusion_matrix_chart = ConfusionMatrixDisplay(cm).plot()
         st.pyplot(confusion_matrix_chart.figure_)
 
+    # Hold-out test set: scored in batches by the best model after the search
+    holdout = results.diagnostics.get('holdout')
+    if holdout is not None:
+        st.write("\n" * 5)
+        st.markdown("<h1 style='text-align: center;'>Hold-Out Test Set</h1>", unsafe_allow_html=True)
+        profit_col, f1_col, recall_col, speed_col = st.columns(4)
+        profit_col.metric("Test Profit", f"{holdout['metrics']['profit']:,.1f}")
+        f1_col.metric("Test F1", f"{holdout['metrics']['f1']:.4f}")
+        recall_col.metric("Test Recall", f"{holdout['metrics']['recall']:.4f}")
+        speed_col.metric("Scoring Throughput (rows/s)", f"{holdout['rows_per_second']:,.0f}")
+        st.caption(f"{holdout['rows']:,} test rows in batches of {holdout['batch_rows']:,} on {holdout['n_jobs']} thread(s), "
+                   f"{holdout['seconds']:.2f}s.")
+        counts = holdout['counts']
+        holdout_chart = ConfusionMatrixDisplay(np.array([[counts['tn'], counts['fp']], [counts['fn'], counts['tp']]])).plot()
+        st.pyplot(holdout_chart.figure_)
+
 
     
     # Function to save model results and selections
     def run_model():
         user_name = st.session_state.get('user_name', 'Anonymous')
-        model_name = st.session_state.get('selected_model', 'Default Model')
-        numerical_features = ', '.join(st.session_state.get('selected_num_features', []))
-        categorical_features = ', '.join(st.session_state.get('selected_cat_features', [])) 
-        feature_select_method = st.session_state.get('selected_feature_selection', 'Default Selection')
-        feature_create_method = st.session_state.get('selected_feature_creation', 'Default Creation')
+        # describe the run that produced the results, not the widgets' current state
+        model_name = run_config['model']
+        numerical_features = ', '.join(run_config['numerical_features'])
+        categorical_features = ', '.join(run_config['categorical_features'])
+        feature_select_method = run_config['feature_select']
+        feature_create_method = run_config['feature_create']
         F1score = st.session_state.get('model_F1score', 0)  # Placeholder for where you calculate accuracy
+        # keep the fitted pipeline, keyed like the result store, so the entry can be reopened
+        artifact = save_artifact(results.best_estimator_, config_key(run_config, get_data_fingerprint()))
         
         new_entry = pd.DataFrame([{
             'User Name': user_name,
@@ -560,7 +887,10 @@ elif st.session_state['current_section'] == 'Custom Model Builder':
             'Categorical Features': categorical_features,
             'Feature Selection Method': feature_select_method,
             'Feature Creation Method': feature_create_method,
-            'F1-score': F1score
+            'F1-score': F1score,
+            'Test F1': holdout['metrics']['f1'] if holdout is not None else None,
+            'Test Profit': holdout['metrics']['profit'] if holdout is not None else None,
+            'Artifact': artifact,
         }])
 
         if 'leaderboard' not in st.session_state:
@@ -584,6 +914,26 @@ elif st.session_state['current_section'] == 'Leaderboard':
         sorted_leaderboard = st.session_state['leaderboard'].sort_values(by='F1-score', ascending=False).reset_index(drop=True)
         sorted_leaderboard.index = np.arange(1, len(sorted_leaderboard) + 1)
         st.dataframe(sorted_leaderboard)
+
+        # Reopen a saved model: its artifact is memory-mapped, not refit
+        saved = sorted_leaderboard.dropna(subset=['Artifact']) if 'Artifact' in sorted_leaderboard else sorted_leaderboard.iloc[:0]
+        if not saved.empty:
+            choice = st.selectbox("Reopen a saved model", saved.index,
+                                  format_func=lambda i: f"#{i}: {saved.loc[i, 'User Name']}, {saved.loc[i, 'Model Name']}")
+            if st.button('Score It on the Test Set'):
+                try:
+                    start = time.perf_counter()
+                    model = load_artifact(saved.loc[choice, 'Artifact'])
+                    load_seconds = time.perf_counter() - start
+                except FileNotFoundError:
+                    st.error("This model's artifact is no longer on the server.")
+                else:
+                    holdout = evaluate_holdout(model, X_test, y_test, trace_memory=False)
+                    load_col, profit_col, f1_col, speed_col = st.columns(4)
+                    load_col.metric("Load Time (ms)", f"{load_seconds * 1000:,.1f}")
+                    profit_col.metric("Test Profit", f"{holdout['metrics']['profit']:,.1f}")
+                    f1_col.metric("Test F1", f"{holdout['metrics']['f1']:.4f}")
+                    speed_col.metric("Scoring Throughput (rows/s)", f"{holdout['rows_per_second']:,.0f}")
     else:
         st.write("No leaderboard data available.")
     
@@ -679,8 +1029,10 @@ elif st.session_state['current_section'] == 'Dictionary':
     creation = {
         "Passthrough": "Skips over the Feature Creation",
         "PolynomialFeatures": "Transforms input features by generating polynomial combinations of them, up to a specified degree",
+        "PolynomialFeatures (Chunked, on disk)": "The same polynomial features, built a block of rows at a time into a temporary file on disk instead of all at once in memory. Slower, but high degrees no longer need the whole feature matrix in RAM.",
         "MinMaxScaler": "It scales and transforms the features such that they are mapped to a specified range, typically between 0 and 1. This scaling is achieved by subtracting the minimum value of each feature and then dividing by the range (maximum value minus minimum value) of that feature.",
         "MaxAbsScaler": "It scales and transforms the features such that the absolute values of each feature are mapped to the range [-1, 1]. It is a useful tool for ensuring that features are on a consistent scale, making it easier for machine learning models to learn from the data without being biased by the scale of the features. It's especially beneficial when dealing with sparse data or when you want to preserve the sign of the feature values.",
+        "Sparse Interactions": "Keeps the data sparse from end to end: the optional MinMax or MaxAbs scaling is applied to the numerical features only, and interaction terms are created only for the pairs of features you pick (a categorical feature interacts through its dummies). Use this instead of PolynomialFeatures when categorical features with many values, such as zip_code, are selected.",
     }
     for term, definition in creation.items():
         col1, col2 = st.columns([1, 5])  # Adjust the ratio if needed to accommodate your content
@@ -0,0 +1,55 @@
+'''
+Fitted pipelines saved from the Custom Model Builder.
+
+Every run saved to the leaderboard stores its refit best estimator as
+ARTIFACT_DIR/<config key>.joblib, the key being the same configuration and
+data hash the result store uses (see experiment_cache.py), and the
+leaderboard row records that path. The files are written uncompressed, so
+joblib can memory-map every large NumPy array on load: reopening a model
+(the app, score_batch.py, scoring_service.py) reads the small Python
+objects and maps the arrays instead of refitting or copying them, and
+processes that map the same file share its pages.
+'''
+
+import functools
+import os
+
+import joblib
+
+ARTIFACT_DIR = os.environ.get("LOAN_APP_ARTIFACT_DIR", "artifacts")
+
+
+def artifact_path(key, directory=ARTIFACT_DIR):
+    return os.path.join(directory, f"{key}.joblib")
+
+
+def save_artifact(estimator, key, directory=ARTIFACT_DIR):
+    """Write the estimator under `key` unless it is already there; returns the path."""
+    path = artifact_path(key, directory)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(estimator, tmp_path, compress=0)  # compressed arrays cannot be memory-mapped
+        os.replace(tmp_path, path)
+    return path
+
+
+def resolve(ref, directory=ARTIFACT_DIR):
+    """A file path as is, or the artifact path of a configuration key."""
+    if os.path.exists(ref):
+        return ref
+    path = artifact_path(ref, directory)
+    if os.path.exists(path):
+        return path
+    raise FileNotFoundError(f"no model file or artifact named {ref!r}")
+
+
+@functools.lru_cache(maxsize=8)
+def load_artifact(ref):
+    """
+    The fitted pipeline in a model file or artifact, with its arrays
+    memory-mapped read-only. A stored search result (see search.py) gives
+    its best estimator. Cached per process: models are loaded once.
+    """
+    model = joblib.load(resolve(ref), mmap_mode="r")
+    return getattr(model, "best_estimator_", model)
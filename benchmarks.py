@@ -0,0 +1,412 @@
+'''
+Timing scripts for the performance work in app.py and its helper modules.
+
+Run one benchmark with e.g. `python benchmarks.py loader`, or all of them
+with `python benchmarks.py`. They print plain tables and write nothing
+except the caches the app itself would build.
+'''
+
+import functools
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from loan_data import DATA_CACHE, DATA_CSV, build_columnar_cache, load_loans, split_loans
+from scoring import custom_prof_score, loan_metrics
+
+
+def _timeit(fn, repeat=3):
+    # best of `repeat` runs, in seconds
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_loader():
+    '''
+    Cold start and rerun latency of the old CSV path against the columnar
+    cache. "rerun" is what a Streamlit rerun pays once the split is in the
+    process-wide cache.
+    '''
+
+    def csv_path():
+        loans = pd.read_csv(DATA_CSV)
+        loans = loans.drop("id", axis=1)
+        return split_loans(loans)
+
+    def parquet_cold():
+        if os.path.exists(DATA_CACHE):
+            os.remove(DATA_CACHE)
+        return split_loans(build_columnar_cache())
+
+    def parquet_warm():
+        return split_loans(load_loans())
+
+    cached = functools.lru_cache(maxsize=1)(parquet_warm)
+    cached()
+
+    rows = [
+        ("csv (every rerun today)", _timeit(csv_path)),
+        ("parquet, cache build", _timeit(parquet_cold, repeat=1)),
+        ("parquet, warm read", _timeit(parquet_warm)),
+        ("rerun with process cache", _timeit(cached)),
+    ]
+    print(pd.DataFrame(rows, columns=["path", "seconds"]).to_string(index=False))
+
+
+def bench_scorer(sizes=(100_000, 10_000_000)):
+    '''
+    The old profit scorer (built-in sum over boolean Series) against the
+    bincount version, and the multi-metric scorer against one
+    sklearn call per metric.
+    '''
+    from sklearn.metrics import f1_score, precision_score, recall_score
+
+    def legacy_prof_score(y, y_pred, roa=0.02, haircut=0.20):
+        TN = sum((y_pred == 0) & (y == 0))
+        FN = sum((y_pred == 0) & (y == 1))
+        return TN * roa - FN * haircut
+
+    def legacy_metrics(y, y_pred):
+        return (
+            legacy_prof_score(y, y_pred),
+            f1_score(y, y_pred),
+            precision_score(y, y_pred),
+            recall_score(y, y_pred),
+        )
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for n in sizes:
+        y = pd.Series(rng.random(n) < 0.16)
+        y_pred = rng.random(n) < 0.3
+        repeat = 1 if n > 1_000_000 else 3
+        rows.append((n, "profit, legacy", _timeit(lambda: legacy_prof_score(y, y_pred), repeat)))
+        rows.append((n, "profit, bincount", _timeit(lambda: custom_prof_score(y, y_pred), repeat)))
+        rows.append((n, "4 metrics, legacy", _timeit(lambda: legacy_metrics(y, y_pred), repeat)))
+        rows.append((n, "4 metrics, one pass", _timeit(lambda: loan_metrics(y, y_pred), repeat)))
+    print(pd.DataFrame(rows, columns=["rows", "scorer", "seconds"]).to_string(index=False))
+
+
+def bench_onehot(n_splits=5):
+    '''
+    Encoding the categorical columns of each CV training fold: the
+    OneHotEncoder ColumnTransformer against slicing the precomputed blocks.
+    '''
+    from sklearn.compose import make_column_transformer
+    from sklearn.model_selection import KFold
+    from sklearn.preprocessing import OneHotEncoder
+
+    from features import ONEHOT_STORE, OneHotBlockEncoder, build_onehot_store, load_onehot_store
+
+    loans = load_loans()
+    X_train, X_test, y_train, y_test = split_loans(loans)
+    cat_cols = X_train.select_dtypes(include=["object", "category"]).columns
+
+    build_time = _timeit(lambda: build_onehot_store(loans.drop("loan_status", axis=1)), repeat=1)
+    load_onehot_store(ONEHOT_STORE)
+    folds = [train for train, _ in KFold(n_splits, shuffle=True, random_state=42).split(X_train)]
+
+    def encode_all(encoder):
+        for train in folds:
+            fold = X_train.iloc[train]
+            make_column_transformer((encoder, cat_cols)).fit_transform(fold)
+
+    rows = [
+        ("block store build (once)", build_time),
+        ("OneHotEncoder, all folds", _timeit(lambda: encode_all(OneHotEncoder(handle_unknown="ignore")))),
+        ("cached blocks, all folds", _timeit(lambda: encode_all(OneHotBlockEncoder()))),
+    ]
+    print(pd.DataFrame(rows, columns=["path", "seconds"]).to_string(index=False))
+
+
+def _peak_memory(fn):
+    # (seconds, peak MiB allocated while fn runs); errors are reported, not raised
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        fn()
+        error = ""
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"[:60]
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return seconds, peak, error
+
+
+def bench_feature_create():
+    '''
+    Fit time and peak memory of feature creation on the training set with
+    every numeric feature plus zip_code and addr_state: the current
+    after-the-ColumnTransformer step against the sparse path.
+    '''
+    from sklearn.compose import make_column_transformer
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import MaxAbsScaler, MinMaxScaler, PolynomialFeatures, StandardScaler
+
+    from features import OneHotBlockEncoder, PairInteractions
+
+    X_train, X_test, y_train, y_test = split_loans(load_loans())
+    num_cols = list(X_train.select_dtypes(include="float64").columns)
+    cat_cols = ["zip_code", "addr_state"]
+    pairs = [("int_rate", "annual_inc"), ("int_rate", "grade"), ("dti", "zip_code")]
+
+    def current(creator):
+        preproc = make_column_transformer(
+            (make_pipeline(SimpleImputer(strategy="mean"), StandardScaler()), num_cols),
+            (OneHotBlockEncoder(), cat_cols),
+        )
+        return make_pipeline(preproc, creator, LogisticRegression(class_weight="balanced"))
+
+    def sparse(scaler):
+        numer_pipe = make_pipeline(SimpleImputer(strategy="mean"), StandardScaler(), scaler)
+        preproc = make_column_transformer(
+            (numer_pipe, num_cols),
+            (OneHotBlockEncoder(), cat_cols),
+            (PairInteractions(pairs=pairs), sorted({c for p in pairs for c in p})),
+            sparse_threshold=1.0,
+        )
+        return make_pipeline(preproc, LogisticRegression(class_weight="balanced"))
+
+    paths = [
+        ("current, PolynomialFeatures(2)", lambda: current(PolynomialFeatures(degree=2))),
+        ("current, MinMaxScaler", lambda: current(MinMaxScaler())),
+        ("current, MaxAbsScaler", lambda: current(MaxAbsScaler())),
+        ("sparse, MinMaxScaler + 3 pairs", lambda: sparse(MinMaxScaler())),
+        ("sparse, MaxAbsScaler + 3 pairs", lambda: sparse(MaxAbsScaler())),
+    ]
+    rows = []
+    for name, build in paths:
+        seconds, peak, error = _peak_memory(lambda: build().fit(X_train, y_train))
+        rows.append((name, seconds, peak, error))
+    print(pd.DataFrame(rows, columns=["path", "fit seconds", "peak MiB", "error"]).to_string(index=False))
+
+
+def bench_poly_chunked(degrees=range(2, 6), n_numeric=8):
+    '''
+    Peak memory and time of building the degree 2-5 polynomial features of
+    the training set: PolynomialFeatures in memory against
+    ChunkedPolynomialFeatures into a memory-mapped file. Pages of the
+    memory map are not allocations, so tracemalloc counts the chunks only;
+    "mapped MiB" is the file, which the OS may also keep resident while
+    there is free RAM (it can evict those pages, unlike allocations).
+
+    Two inputs. "app design" is the matrix the app's column transformer
+    makes from every numeric and categorical feature (imputed and scaled
+    numerics, the one-hot block store), which is what a run with all
+    features selected expands. Its one-hot block is hundreds of columns
+    wide, so past degree 2 the output is far beyond any disk, let alone
+    RAM: degrees whose dense output exceeds the LOAN_APP_MAX_DISK_BYTES
+    limit are listed with their size and skipped, as the app would refuse
+    them. "first n numeric" is the first `n_numeric` standardized numeric
+    features alone, small enough to time every degree.
+    '''
+    from sklearn.compose import make_column_transformer
+    from sklearn.impute import SimpleImputer
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import PolynomialFeatures, StandardScaler
+
+    from cost_estimate import MAX_DISK_BYTES, format_bytes, polynomial_width
+    from features import ChunkedPolynomialFeatures, OneHotBlockEncoder
+
+    X_train, X_test, y_train, y_test = split_loans(load_loans())
+    num_cols = list(X_train.select_dtypes(include="float64").columns)
+    cat_cols = list(X_train.select_dtypes(include=["object", "category"]).columns)
+    numer_pipe = make_pipeline(SimpleImputer(strategy="mean"), StandardScaler())
+    inputs = [
+        ("app design", make_column_transformer((numer_pipe, num_cols), (OneHotBlockEncoder(), cat_cols)).fit_transform(X_train)),
+        (f"first {n_numeric} numeric", numer_pipe.fit_transform(X_train[num_cols[:n_numeric]])),
+    ]
+
+    rows = []
+    for input_name, X in inputs:
+        for degree in degrees:
+            width = polynomial_width(X.shape[1], degree)
+            out_bytes = X.shape[0] * width * 8
+            if out_bytes > MAX_DISK_BYTES:
+                rows.append((input_name, degree, "skipped", width, None, None, out_bytes / 2**20,
+                             f"output {format_bytes(out_bytes)} is over the disk limit"))
+                continue
+            for name, creator in [
+                ("in memory", PolynomialFeatures(degree=degree)),
+                ("chunked, memmap", ChunkedPolynomialFeatures(degree=degree)),
+            ]:
+                seconds, peak, error = _peak_memory(lambda: creator.fit_transform(X))
+                mapped = out_bytes / 2**20 if isinstance(creator, ChunkedPolynomialFeatures) else 0.0
+                rows.append((input_name, degree, name, width, seconds, peak, mapped, error))
+        print(f"{input_name}: {X.shape[0]:,} rows, {X.shape[1]:,} columns")
+    print(pd.DataFrame(rows, columns=["input", "degree", "path", "columns", "seconds", "peak MiB", "mapped MiB", "error"]).to_string(index=False))
+
+
+def bench_knn(sizes=(107_000, 1_000_000), ks=range(1, 21), n_features=16, baseline_ks=3):
+    '''
+    One train/test fold of the n_neighbors grid: a KNeighborsClassifier fit
+    and predict per k (timed for the first `baseline_ks` values and scaled to
+    the whole grid) against one shared k_max neighbor table per index.
+    Gaussian features stand in for the standardized numeric loan features.
+    '''
+    from sklearn.neighbors import KNeighborsClassifier
+
+    from path_search import _knn_path
+
+    ks = list(ks)
+    rng = np.random.default_rng(0)
+    rows = []
+    for n in sizes:
+        X = rng.standard_normal((n, n_features)).astype(np.float64)
+        y = rng.random(n) < 0.16
+        cut = int(n * 0.8)
+        X_tr, X_te, y_tr = X[:cut], X[cut:], y[:cut]
+
+        def per_k():
+            for k in ks[:baseline_ks]:
+                KNeighborsClassifier(n_neighbors=k).fit(X_tr, y_tr).predict_proba(X_te)
+
+        per_k_time = _timeit(per_k, repeat=1) * len(ks) / baseline_ks
+        rows.append((n, "refit per k (scaled)", per_k_time, 1.0))
+        for index in ("brute", "kd_tree", "ball_tree"):
+            seconds = _timeit(lambda: _knn_path(
+                KNeighborsClassifier(), X_tr, y_tr, X_te,
+                [{"n_neighbors": k} for k in ks], {"knn_index": index},
+            ), repeat=1)
+            rows.append((n, f"shared table, {index}", seconds, per_k_time / seconds))
+    print(pd.DataFrame(rows, columns=["rows", "path", "seconds", "speedup"]).to_string(index=False))
+
+
+def bench_tree(splits=range(2, 51)):
+    '''
+    One train/test fold of the min_samples_split grid on the numeric loan
+    features: a DecisionTreeClassifier per value against one grown tree read
+    off at every value. Also the max_depth and ccp_alpha paths.
+    '''
+    from sklearn.impute import SimpleImputer
+    from sklearn.model_selection import train_test_split
+    from sklearn.tree import DecisionTreeClassifier
+
+    from path_search import _tree_path
+
+    X_train, X_test, y_train, y_test = split_loans(load_loans())
+    X = SimpleImputer().fit_transform(X_train.select_dtypes(include="float64"))
+    X_tr, X_te, y_tr, y_te = train_test_split(X, y_train.to_numpy(), test_size=0.2, random_state=0)
+    clf = DecisionTreeClassifier(class_weight="balanced", random_state=0)
+
+    grids = [
+        ("min_samples_split", [{"min_samples_split": m} for m in splits]),
+        ("max_depth", [{"max_depth": d} for d in range(1, 31)]),
+        ("ccp_alpha", [{"ccp_alpha": a} for a in np.linspace(0, 0.001, 10)]),
+    ]
+    rows = []
+    for name, param_sets in grids:
+        def per_value():
+            for params in param_sets:
+                clf.set_params(min_samples_split=2, max_depth=None, ccp_alpha=0.0)
+                clf.set_params(**params).fit(X_tr, y_tr).predict_proba(X_te)
+
+        refit_time = _timeit(per_value, repeat=1)
+        path_time = _timeit(lambda: _tree_path(clf, X_tr, y_tr, X_te, param_sets, {}), repeat=1)
+        rows.append((name, len(param_sets), refit_time, path_time, refit_time / path_time))
+    print(pd.DataFrame(rows, columns=["grid", "values", "refit s", "one tree s", "speedup"]).to_string(index=False))
+
+
+def bench_svd(components=range(5, 26)):
+    '''
+    Fit time of the PCA (TruncatedSVD) component grid on one fold of the
+    preprocessed training set with every feature selected: a fresh SVD per
+    candidate against one SVD at the largest rank, sliced.
+    '''
+    from sklearn.compose import make_column_transformer
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.impute import SimpleImputer
+    from sklearn.model_selection import train_test_split
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    from features import OneHotBlockEncoder
+    from path_search import _svd_path
+
+    X_train, X_test, y_train, y_test = split_loans(load_loans())
+    preproc = make_column_transformer(
+        (make_pipeline(SimpleImputer(strategy="mean"), StandardScaler()), X_train.select_dtypes(include="float64").columns),
+        (OneHotBlockEncoder(), X_train.select_dtypes(include=["object", "category"]).columns),
+    )
+    X = preproc.fit_transform(X_train)
+    X_tr, X_te, y_tr, y_te = train_test_split(X, y_train.to_numpy(), test_size=0.2, random_state=0)
+    param_sets = [{"n_components": c} for c in components]
+
+    def per_candidate():
+        for params in param_sets:
+            svd = TruncatedSVD(**params)
+            svd.fit_transform(X_tr)
+            svd.transform(X_te)
+
+    per_candidate_time = _timeit(per_candidate, repeat=1)
+    sliced_time = _timeit(lambda: list(_svd_path(TruncatedSVD(), X_tr, y_tr, X_te, param_sets, {})), repeat=1)
+    rows = [
+        ("SVD per candidate", per_candidate_time, 1.0),
+        ("one SVD, sliced", sliced_time, per_candidate_time / sliced_time),
+    ]
+    print(f"{X.shape[1]} features, {len(param_sets)} candidates")
+    print(pd.DataFrame(rows, columns=["path", "seconds", "speedup"]).to_string(index=False))
+
+
+def bench_holdout(batch_sizes=(2_000, 10_000, 50_000), workers=(1, 4)):
+    '''
+    Throughput and peak traced memory of evaluate_holdout on the test split
+    for a logistic regression on the numeric features plus zip_code and
+    addr_state. Memory is only traced here: tracemalloc covers the whole
+    process, so the app scores without it.
+    '''
+    from sklearn.compose import make_column_transformer
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    from holdout import evaluate_holdout
+
+    X_train, X_test, y_train, y_test = split_loans(load_loans())
+    num_cols = list(X_train.select_dtypes(include="float64").columns)
+    cat_cols = ["zip_code", "addr_state"]
+    preproc = make_column_transformer(
+        (make_pipeline(SimpleImputer(strategy="mean"), StandardScaler()), num_cols),
+        (OneHotEncoder(handle_unknown="ignore"), cat_cols),
+    )
+    model = make_pipeline(preproc, LogisticRegression(class_weight="balanced")).fit(X_train, y_train)
+
+    rows = []
+    for batch_rows in batch_sizes:
+        for n_jobs in workers:
+            out = evaluate_holdout(model, X_test, y_test, batch_rows=batch_rows, n_jobs=n_jobs, trace_memory=True)
+            rows.append((batch_rows, n_jobs, out["rows_per_second"], out["peak_bytes"] / 2**20))
+    print(f"{len(X_test):,} test rows")
+    print(pd.DataFrame(rows, columns=["batch rows", "threads", "rows/s", "peak MiB"]).to_string(index=False))
+
+
+BENCHMARKS = {
+    "loader": bench_loader,
+    "scorer": bench_scorer,
+    "onehot": bench_onehot,
+    "feature_create": bench_feature_create,
+    "poly_chunked": bench_poly_chunked,
+    "knn": bench_knn,
+    "tree": bench_tree,
+    "svd": bench_svd,
+    "holdout": bench_holdout,
+}
+
+if __name__ == "__main__":
+
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()
@@ -0,0 +1,329 @@
+'''
+What a Custom Model Builder search will cost, worked out before anything is
+fitted.
+
+The feature count comes from the data and the pipeline's settings. The fit
+counts follow the loops sklearn runs, including the inner cross-validation
+of RFECV and SequentialFeatureSelector: inside a grid search that is nested
+cross-validation, and it multiplies everything else.
+
+estimate_cost() gathers the numbers the app checks against the limits below
+(set through the environment) before Run Model starts anything;
+fit_seconds() adds a wall-time estimate timed on a small subsample.
+'''
+
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.feature_selection import RFECV, SelectFromModel, SequentialFeatureSelector
+from sklearn.model_selection import ParameterGrid, check_cv, train_test_split
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, PolynomialFeatures
+from sklearn.utils import resample
+
+from features import ChunkedPolynomialFeatures, OneHotBlockEncoder, PairInteractions, _categories
+from path_search import PathSearch, _key, _sfs_target, _split_params
+from scoring import decision_scores
+from search import planned_fits
+
+# a configuration over any of these is not run
+MAX_DESIGN_BYTES = int(os.environ.get("LOAN_APP_MAX_DESIGN_BYTES", 2 * 1024**3))  # all workers together
+MAX_DISK_BYTES = int(os.environ.get("LOAN_APP_MAX_DISK_BYTES", 20 * 1024**3))  # memory-mapped features
+MAX_FITS = int(os.environ.get("LOAN_APP_MAX_FITS", 50_000))
+MAX_SECONDS = float(os.environ.get("LOAN_APP_MAX_SECONDS", 2 * 3600))
+# rows in the timed calibration fit
+CALIBRATION_ROWS = int(os.environ.get("LOAN_APP_CALIBRATION_ROWS", 2000))
+
+
+def design_matrix_shape(pipe, X, degree=None):
+    """
+    (columns, nonzeros per row, sparse?) of the matrix the create_pipeline
+    preprocessing and feature_create steps produce for X. `degree` overrides
+    a PolynomialFeatures step's degree.
+    """
+    width, nnz, sparse = _preprocessed_shape(pipe, X)
+
+    creator = pipe.named_steps["feature_create"]
+    if isinstance(creator, (PolynomialFeatures, ChunkedPolynomialFeatures)):
+        degree = creator.degree if degree is None else degree
+        poly = (degree, creator.interaction_only, creator.include_bias)
+        # products of nonzero entries are the only nonzero monomials
+        nnz = polynomial_width(nnz, *poly) if sparse else polynomial_width(width, *poly)
+        width = polynomial_width(width, *poly)
+    if isinstance(creator, ChunkedPolynomialFeatures):
+        sparse = False  # written out dense
+    if not sparse:
+        nnz = width
+    return width, nnz, sparse
+
+
+def _preprocessed_shape(pipe, X):
+    # the same triple for the column transformer's output alone
+    preproc = pipe.named_steps["columntransformer"]
+    width = nnz = 0
+    any_sparse = False
+    for _, transformer, columns in preproc.transformers:
+        block_width, block_nnz, block_sparse = _block_shape(transformer, X, list(columns))
+        width += block_width
+        nnz += block_nnz
+        any_sparse |= block_sparse
+    # ColumnTransformer's rule for stacking the blocks sparse
+    sparse = any_sparse and nnz < preproc.sparse_threshold * max(width, 1)
+    return width, nnz if sparse else width, sparse
+
+
+def _block_shape(transformer, X, columns):
+    if isinstance(transformer, Pipeline):
+        transformer = transformer.steps[-1][1]
+    if isinstance(transformer, (OneHotBlockEncoder, OneHotEncoder)):
+        # one nonzero per column and row (none for unknown categories)
+        return sum(len(_categories(X[col])) for col in columns), len(columns), True
+    if isinstance(transformer, PairInteractions):
+        return sum(_pair_width(X, a, b) for a, b in transformer.pairs), len(transformer.pairs), True
+    if isinstance(transformer, str) and transformer == "drop":
+        return 0, 0, False
+    return len(columns), len(columns), False
+
+
+def _pair_width(X, a, b):
+    numeric_a = pd.api.types.is_numeric_dtype(X[a])
+    numeric_b = pd.api.types.is_numeric_dtype(X[b])
+    if numeric_a and numeric_b:
+        return 1
+    if numeric_a or numeric_b:
+        return len(_categories(X[b] if numeric_a else X[a]))
+    # one dummy per combination that occurs
+    return len(X[[a, b]].drop_duplicates())
+
+
+def matrix_bytes(n_rows, n_features, nnz_per_row, sparse):
+    """float64 storage: n_rows x n_features dense, or CSR with int32/int64 indices."""
+    if not sparse:
+        return n_rows * n_features * 8
+    nnz = n_rows * nnz_per_row
+    index_bytes = 4 if max(nnz, n_features) < 2**31 else 8
+    return nnz * (8 + index_bytes) + (n_rows + 1) * index_bytes
+
+
+def polynomial_width(n_features, degree, interaction_only=False, include_bias=True):
+    """PolynomialFeatures' output width: C(n + d, d) monomials of degree <= d."""
+    if interaction_only:
+        width = sum(math.comb(n_features, i) for i in range(min(degree, n_features) + 1))
+    else:
+        width = math.comb(n_features + degree, degree)
+    return width - (not include_bias)
+
+
+def selector_fits(selector, n_features, params=None):
+    """
+    Estimator fits in one fit of a feature_select step, inner CV included.
+    For RFECV this is an upper bound: the final elimination on the whole
+    fold stops at the chosen feature count.
+    """
+    if isinstance(selector, str):
+        return 0
+    selector = clone(selector).set_params(**(params or {}))
+    if isinstance(selector, RFECV):
+        n_splits = check_cv(selector.cv).get_n_splits()
+        rounds = _rfe_rounds(n_features, selector.step, selector.min_features_to_select)
+        # each inner fold eliminates down to the minimum, then the whole fold
+        # is eliminated again and the estimator fitted on what is left
+        return (n_splits + 1) * rounds + 1
+    if isinstance(selector, SequentialFeatureSelector):
+        n_splits = check_cv(selector.cv).get_n_splits()
+        # counts past the width are not fitted (see path_search.SELECTOR_LIMITS)
+        n_select = min(_sfs_target(selector.n_features_to_select, n_features), n_features)
+        if selector.direction == "forward":
+            changes = range(n_select)
+        else:
+            changes = range(n_features - n_select)
+        # every remaining feature is tried, with an inner CV, at every change
+        return n_splits * sum(n_features - i for i in changes)
+    if isinstance(selector, SelectFromModel):
+        return 1
+    return 0
+
+
+def _rfe_rounds(n_features, step, target):
+    if step < 1:
+        step = max(1, int(step * n_features))
+    return math.ceil(max(n_features - target, 0) / step) + 1
+
+
+def search_fits(search, n_features, n_samples):
+    """
+    Model fits a search will run, as a dict:
+
+        scored    (candidate, fold) pairs, what the progress bar counts
+        selector  estimator fits inside feature_select, inner CV included
+        total     scored + selector + the final refit of the best candidate
+
+    GridSearchCV and the subsample searches fit feature_select again for
+    every candidate, unless the pipeline cache serves the repeat, so their
+    counts are upper bounds. PathSearch fits each distinct setting once per
+    fold, and forward selection once per fold, up to the largest n.
+    """
+    selector = search.estimator.named_steps["feature_select"]
+    candidates = list(ParameterGrid(search.param_grid))
+    n_splits = search.cv.get_n_splits()
+    scored = planned_fits(search, n_samples)
+
+    per_setting = {}
+    per_candidate = []
+    for params in candidates:
+        select_params = _split_params(params, "feature_select")
+        key = _key(select_params)
+        if key not in per_setting:
+            per_setting[key] = selector_fits(selector, n_features, select_params)
+        per_candidate.append(per_setting[key])
+
+    if isinstance(search, PathSearch) and _shares_forward_path(selector):
+        selector_total = max(per_setting.values()) * n_splits
+    elif isinstance(search, PathSearch):
+        selector_total = sum(per_setting.values()) * n_splits
+    else:
+        selector_total = int(round(np.mean(per_candidate) * scored))
+    refit = max(per_candidate) + 1
+    return {
+        "scored": scored,
+        "selector": selector_total,
+        "total": scored + selector_total + refit,
+    }
+
+
+def _shares_forward_path(selector):
+    # the cases path_search._sfs_path serves from one greedy path
+    return (
+        isinstance(selector, SequentialFeatureSelector)
+        and selector.direction == "forward"
+        and selector.tol is None
+    )
+
+
+def estimate_cost(search, X, n_jobs=1):
+    """
+    Size and fit count of a search over X, without fitting anything. Every
+    worker holds a design matrix of about the full training size, so
+    peak_bytes is the matrix the pipeline produces times the workers. With
+    ChunkedPolynomialFeatures that matrix is on disk (disk_bytes) and memory
+    holds its input and one chunk; create_pipeline turns the step cache off
+    for it, so there is no second copy in the pipeline cache.
+    """
+    n_jobs = max(n_jobs, 1)
+    n_features, nnz_per_row, sparse = design_matrix_shape(search.estimator, X)
+    dense_bytes = matrix_bytes(len(X), n_features, n_features, sparse=False)
+    sparse_bytes = matrix_bytes(len(X), n_features, nnz_per_row, sparse=True)
+    peak_bytes = sparse_bytes if sparse else dense_bytes
+    disk_bytes = 0
+
+    creator = search.estimator.named_steps["feature_create"]
+    if isinstance(creator, ChunkedPolynomialFeatures):
+        disk_bytes = dense_bytes
+        peak_bytes = matrix_bytes(len(X), *_preprocessed_shape(search.estimator, X)) + creator.chunk_bytes
+    return {
+        "n_features": n_features,
+        "sparse": sparse,
+        "dense_bytes": dense_bytes,
+        "sparse_bytes": sparse_bytes,
+        "peak_bytes": peak_bytes * n_jobs,
+        "disk_bytes": disk_bytes * n_jobs,
+        "fits": search_fits(search, n_features, len(X)),
+    }
+
+
+def fit_seconds(search, X, y, estimate, n_jobs=1, n_rows=CALIBRATION_ROWS):
+    """
+    Rough wall time of the search: the first candidate is fitted and scored
+    once on a stratified subsample of n_rows, split like a fold. The time
+    per model fit is scaled linearly to the training-fold size, times the
+    fit count. The scoring time is scaled to the test-fold size, or for
+    nearest neighbors (a distance per training and test row pair) to
+    training times test rows, times the scoring passes. The total is spread
+    over the workers. Budgeted searches stop at their time budget.
+    """
+    n_rows = min(n_rows, len(X))
+    n_splits = search.cv.get_n_splits()
+    X_sample, y_sample = resample(X, y, n_samples=n_rows, replace=False, stratify=y, random_state=0)
+    X_fit, X_score, y_fit, _ = train_test_split(X_sample, y_sample, test_size=1 / n_splits, stratify=y_sample, random_state=0)
+    params = next(iter(ParameterGrid(search.param_grid)))
+    pipe = clone(search.estimator).set_params(memory=None, **params)
+
+    start = time.perf_counter()
+    pipe.fit(X_fit, y_fit)
+    fit_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    decision_scores(pipe, X_score)
+    score_elapsed = time.perf_counter() - start
+
+    fits_in_sample = selector_fits(
+        search.estimator.named_steps["feature_select"], estimate["n_features"], _split_params(params, "feature_select")
+    ) + 1
+    train_rows = len(X) * (n_splits - 1) / n_splits
+    test_rows = len(X) / n_splits
+    per_fit = fit_elapsed / fits_in_sample * train_rows / len(X_fit)
+    if isinstance(search.estimator.named_steps["clf"], KNeighborsClassifier):
+        per_score = score_elapsed * (train_rows * test_rows) / (len(X_fit) * len(X_score))
+    else:
+        per_score = score_elapsed * test_rows / len(X_score)
+    seconds = (per_fit * estimate["fits"]["total"] + per_score * _scoring_passes(search, estimate["fits"]["scored"])) / max(n_jobs, 1)
+    if getattr(search, "time_budget", None):
+        # budgeted searches stop themselves
+        seconds = min(seconds, search.time_budget)
+    return seconds
+
+
+def _scoring_passes(search, scored):
+    # PathSearch answers every n_neighbors from one neighbor table per fold
+    # and preprocessing/selection setting; otherwise each scored fit predicts
+    if isinstance(search, PathSearch) and isinstance(search.estimator.named_steps["clf"], KNeighborsClassifier):
+        settings = {
+            _key({name: value for name, value in params.items() if not name.startswith("clf__")})
+            for params in ParameterGrid(search.param_grid)
+        }
+        return len(settings) * search.cv.get_n_splits()
+    return scored
+
+
+def limit_problems(estimate, seconds=None):
+    """Why a configuration is over the limits, one sentence each; empty when it is not."""
+    problems = []
+    if estimate["peak_bytes"] > MAX_DESIGN_BYTES:
+        problems.append(
+            f"Its design matrices need about {format_bytes(estimate['peak_bytes'])} in memory, "
+            f"over the {format_bytes(MAX_DESIGN_BYTES)} limit."
+        )
+    if estimate["disk_bytes"] > MAX_DISK_BYTES:
+        problems.append(
+            f"Its memory-mapped features need about {format_bytes(estimate['disk_bytes'])} of disk, "
+            f"over the {format_bytes(MAX_DISK_BYTES)} limit."
+        )
+    if estimate["fits"]["total"] > MAX_FITS:
+        problems.append(f"It runs {estimate['fits']['total']:,} model fits, over the {MAX_FITS:,} limit.")
+    if seconds is not None and seconds > MAX_SECONDS:
+        problems.append(f"It should take about {seconds / 60:.0f} minutes, over the {MAX_SECONDS / 60:.0f} minute limit.")
+    return problems
+
+
+def largest_fitting_degree(pipe, X, n_jobs=1, bytes_limit=MAX_DESIGN_BYTES):
+    """Highest PolynomialFeatures degree below the pipeline's whose matrices fit in bytes_limit, or None."""
+    creator = pipe.named_steps["feature_create"]
+    if not isinstance(creator, PolynomialFeatures):
+        return None
+    for degree in range(creator.degree - 1, 0, -1):
+        n_features, nnz_per_row, sparse = design_matrix_shape(pipe, X, degree=degree)
+        if matrix_bytes(len(X), n_features, nnz_per_row, sparse) * max(n_jobs, 1) <= bytes_limit:
+            return degree
+    return None
+
+
+def format_bytes(n_bytes):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if n_bytes < 1024:
+            return f"{n_bytes:.0f} {unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} TiB"
@@ -0,0 +1,115 @@
+'''
+Content-addressed store of finished Custom Model Builder searches.
+
+A search is keyed by the SHA-256 of its configuration (model, features,
+selection/creation methods, folds, param grid and every plain pipeline
+parameter) together with a fingerprint of the training data. Changing the
+data changes every key, so old results are simply never looked up again and
+age out of the store through the LRU size limit.
+'''
+
+import hashlib
+import json
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+
+RESULT_STORE_DIR = os.environ.get("LOAN_APP_RESULT_STORE", ".cache/results")
+RESULT_STORE_BYTES = int(os.environ.get("LOAN_APP_RESULT_STORE_BYTES", 1024**3))
+
+# pipeline parameters that do not change what a search computes
+_IGNORED_PARAMS = ("memory", "n_jobs", "verbose", "copy")
+
+
+def data_fingerprint(X, y):
+    """Hash of the training rows (values and index) and the labels."""
+    h = hashlib.sha256()
+    h.update(pd.util.hash_pandas_object(X, index=True).to_numpy().tobytes())
+    h.update(pd.util.hash_pandas_object(y, index=True).to_numpy().tobytes())
+    h.update(",".join(map(str, X.columns)).encode())
+    return h.hexdigest()
+
+
+def pipeline_params(pipe):
+    """
+    The plain (non-estimator) parameters of a pipeline, e.g. the class_weight
+    picked for the selector's model, in a JSON-friendly form.
+    """
+    params = {}
+    for name, value in pipe.get_params(deep=True).items():
+        if name.split("__")[-1] in _IGNORED_PARAMS:
+            continue
+        if value is None or isinstance(value, (str, bool, int, float, np.generic)):
+            params[name] = value
+    return params
+
+
+def config_key(config, fingerprint):
+    payload = json.dumps({"config": config, "data": fingerprint}, sort_keys=True, default=_jsonable)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (pd.Index, pd.Series)):
+        return list(value)
+    return repr(value)
+
+
+class ResultStore:
+    """
+    One joblib file per key under `location`. get() refreshes the file's
+    mtime, and put() evicts the least recently used files until the store
+    fits in bytes_limit.
+    """
+
+    def __init__(self, location=RESULT_STORE_DIR, bytes_limit=RESULT_STORE_BYTES):
+        self.location = location
+        self.bytes_limit = bytes_limit
+        os.makedirs(location, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.location, f"{key}.joblib")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            result = joblib.load(path)
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return result
+
+    def put(self, key, result):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(result, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.location):
+            if not name.endswith(".joblib"):
+                continue
+            path = os.path.join(self.location, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.bytes_limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,282 @@
+'''
+Feature transformers used by create_pipeline in app.py.
+
+OneHotBlockEncoder replaces OneHotEncoder(handle_unknown='ignore') for the
+loan data. Every categorical column is one-hot encoded once, over all loans,
+into a CSR block that is persisted in ONEHOT_STORE and indexed by loan id.
+Encoding a fold then takes a row slice of each selected block and a
+horizontal stack.
+
+The vocabularies come from every loan, not from the fold being fitted. That
+is still fold-safe: a category that is missing from a training fold gives a
+column that is all zeros in that fold, so it gets no weight, no split and no
+distance difference between training rows. The fitted model predicts
+exactly as it would with OneHotEncoder ignoring that unseen category.
+'''
+
+import functools
+import os
+import tempfile
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_selection import SelectKBest
+from sklearn.preprocessing import PolynomialFeatures
+
+ONEHOT_STORE = "inputs/onehot_blocks.joblib"
+
+
+def _categories(values):
+    # sorted like OneHotEncoder, with missing values as a last category
+    values = pd.Series(values)
+    categories = np.sort(values.dropna().unique().astype(object))
+    if values.isna().any():
+        categories = np.append(categories, np.nan).astype(object)
+    return categories
+
+
+def _codes(values, categories):
+    """Column of each row in the block, -1 for unknown values."""
+    has_nan = len(categories) and isinstance(categories[-1], float) and np.isnan(categories[-1])
+    known = categories[:-1] if has_nan else categories
+    codes = pd.Categorical(np.asarray(values, dtype=object), categories=known).codes.astype(np.int64)
+    if has_nan:
+        codes[pd.isna(np.asarray(values, dtype=object))] = len(known)
+    return codes
+
+
+def _one_hot(codes, n_categories):
+    rows = np.flatnonzero(codes >= 0)
+    return sp.csr_matrix(
+        (np.ones(len(rows)), (rows, codes[rows])),
+        shape=(len(codes), n_categories),
+    )
+
+
+def build_onehot_store(X, path=ONEHOT_STORE):
+    """Encode every text/categorical column of X once and persist the blocks."""
+    blocks = {}
+    for col in X.select_dtypes(include=["object", "category"]).columns:
+        categories = _categories(X[col])
+        blocks[col] = {
+            "categories": categories,
+            "block": _one_hot(_codes(X[col], categories), len(categories)),
+        }
+
+    tmp_path = path + ".tmp"
+    joblib.dump({"index": X.index, "blocks": blocks}, tmp_path)
+    os.replace(tmp_path, path)
+    load_onehot_store.cache_clear()
+
+
+def ensure_onehot_store(X, path=ONEHOT_STORE, source=None):
+    """Build the store unless it exists and is newer than the `source` data file."""
+    stale = not os.path.exists(path) or (
+        source is not None and os.path.getmtime(path) < os.path.getmtime(source)
+    )
+    if stale:
+        build_onehot_store(X, path)
+    return path
+
+
+@functools.lru_cache(maxsize=4)
+def load_onehot_store(path=ONEHOT_STORE):
+    # one copy per process, shared by every pipeline and session
+    return joblib.load(path)
+
+
+class OneHotBlockEncoder(TransformerMixin, BaseEstimator):
+    """
+    One-hot encoder backed by the block store. Rows whose index is a loan id
+    in the store are served from the cached blocks. Any other frame (new
+    applications, which carry no `id` index) is encoded with the stored
+    vocabularies, ignoring unknown categories like
+    OneHotEncoder(handle_unknown='ignore').
+    """
+
+    def __init__(self, store_path=ONEHOT_STORE):
+        self.store_path = store_path
+
+    def fit(self, X, y=None):
+        store = load_onehot_store(self.store_path)
+        self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        self.categories_ = [store["blocks"][col]["categories"] for col in X.columns]
+        return self
+
+    def _cached_rows(self, X):
+        # only frames indexed by loan id can be looked up in the store
+        if not os.path.exists(self.store_path):
+            return None
+        store = load_onehot_store(self.store_path)
+        if X.index.name is None or X.index.name != store["index"].name:
+            return None
+        positions = store["index"].get_indexer(X.index)
+        if (positions < 0).any():
+            return None
+        return store, positions
+
+    def transform(self, X):
+        cached = self._cached_rows(X)
+        if cached is not None:
+            store, positions = cached
+            blocks = [store["blocks"][col]["block"][positions] for col in self.feature_names_in_]
+        else:
+            blocks = [
+                _one_hot(_codes(X[col], categories), len(categories))
+                for col, categories in zip(self.feature_names_in_, self.categories_)
+            ]
+        if not blocks:
+            return sp.csr_matrix((len(X), 0))
+        return sp.hstack(blocks, format="csr")
+
+    def get_feature_names_out(self, input_features=None):
+        return np.asarray(
+            [f"{col}_{cat}" for col, cats in zip(self.feature_names_in_, self.categories_) for cat in cats],
+            dtype=object,
+        )
+
+
+class PairInteractions(TransformerMixin, BaseEstimator):
+    """
+    Interaction terms for the given column pairs only, returned as CSR.
+
+    numeric x numeric is the product of the two standardized columns,
+    numeric x categorical is the standardized numeric value times each of
+    the categorical's dummies, and categorical x categorical is one dummy per
+    combination seen in fit. Missing numeric values are imputed with the
+    mean (0 after standardizing). Unknown categories get no dummy. The output
+    stays sparse however many levels the categoricals have.
+    """
+
+    def __init__(self, pairs=()):
+        self.pairs = pairs
+
+    def fit(self, X, y=None):
+        self.pairs_ = [tuple(pair) for pair in self.pairs]
+        columns = sorted({col for pair in self.pairs_ for col in pair})
+        self.numeric_ = {}
+        self.categories_ = {}
+        for col in columns:
+            if pd.api.types.is_numeric_dtype(X[col]):
+                values = X[col].to_numpy(dtype=float)
+                mean = np.nanmean(values)
+                std = np.nanstd(values)
+                self.numeric_[col] = (mean, std if std > 0 else 1.0)
+            else:
+                self.categories_[col] = _categories(X[col])
+
+        # cat x cat: remember which combinations exist in the training rows
+        self.combinations_ = {}
+        for a, b in self.pairs_:
+            if a in self.categories_ and b in self.categories_:
+                self.combinations_[(a, b)] = np.unique(self._combined_codes(X, a, b))
+        return self
+
+    def _standardized(self, X, col):
+        mean, std = self.numeric_[col]
+        values = (X[col].to_numpy(dtype=float) - mean) / std
+        return np.nan_to_num(values, nan=0.0)
+
+    def _dummies(self, X, col):
+        categories = self.categories_[col]
+        return _one_hot(_codes(X[col], categories), len(categories))
+
+    def _combined_codes(self, X, a, b):
+        codes_a = _codes(X[a], self.categories_[a])
+        codes_b = _codes(X[b], self.categories_[b])
+        combined = codes_a * len(self.categories_[b]) + codes_b
+        combined[(codes_a < 0) | (codes_b < 0)] = -1
+        return combined[combined >= 0]
+
+    def transform(self, X):
+        blocks = []
+        for a, b in self.pairs_:
+            if a in self.numeric_ and b in self.numeric_:
+                product = self._standardized(X, a) * self._standardized(X, b)
+                blocks.append(sp.csr_matrix(product[:, None]))
+            elif a in self.numeric_ or b in self.numeric_:
+                num, cat = (a, b) if a in self.numeric_ else (b, a)
+                dummies = self._dummies(X, cat)
+                blocks.append(sp.csr_matrix(dummies.multiply(self._standardized(X, num)[:, None])))
+            else:
+                seen = self.combinations_[(a, b)]
+                codes_a = _codes(X[a], self.categories_[a])
+                codes_b = _codes(X[b], self.categories_[b])
+                combined = codes_a * len(self.categories_[b]) + codes_b
+                position = np.searchsorted(seen, combined)
+                known = (codes_a >= 0) & (codes_b >= 0) & (position < len(seen))
+                known[known] = seen[position[known]] == combined[known]
+                blocks.append(_one_hot(np.where(known, position, -1), len(seen)))
+        if not blocks:
+            return sp.csr_matrix((len(X), 0))
+        return sp.hstack(blocks, format="csr")
+
+
+class ChunkedPolynomialFeatures(TransformerMixin, BaseEstimator):
+    """
+    PolynomialFeatures that writes its output one block of rows at a time
+    into a memory-mapped temporary file, so building the design matrix only
+    needs one chunk of output columns in memory. The result is a dense
+    np.memmap (an ndarray, which every model here accepts). The OS pages it
+    in and out as the model reads it, and the file is deleted once the
+    array is garbage collected.
+
+    Rows per chunk are picked so that a chunk of output is at most
+    `chunk_bytes`. `temp_folder` is where the file goes, by default the
+    system temp directory.
+    """
+
+    def __init__(self, degree=2, interaction_only=False, include_bias=True, chunk_bytes=64 * 2**20,
+                 dtype=np.float64, temp_folder=None):
+        self.degree = degree
+        self.interaction_only = interaction_only
+        self.include_bias = include_bias
+        self.chunk_bytes = chunk_bytes
+        self.dtype = dtype
+        self.temp_folder = temp_folder
+
+    def fit(self, X, y=None):
+        self.poly_ = PolynomialFeatures(
+            degree=self.degree, interaction_only=self.interaction_only, include_bias=self.include_bias
+        ).fit(X[:1])
+        self.n_output_features_ = self.poly_.n_output_features_
+        return self
+
+    def transform(self, X):
+        n_rows = X.shape[0]
+        if n_rows == 0:
+            return np.empty((0, self.n_output_features_), dtype=self.dtype)
+
+        itemsize = np.dtype(self.dtype).itemsize
+        chunk_rows = max(1, self.chunk_bytes // (self.n_output_features_ * itemsize))
+        out = np.memmap(
+            tempfile.TemporaryFile(dir=self.temp_folder),
+            dtype=self.dtype,
+            mode="w+",
+            shape=(n_rows, self.n_output_features_),
+        )
+        for start in range(0, n_rows, chunk_rows):
+            chunk = self.poly_.transform(X[start:start + chunk_rows])
+            out[start:start + chunk_rows] = chunk.toarray() if sp.issparse(chunk) else chunk
+        out.flush()
+        return out
+
+    def get_feature_names_out(self, input_features=None):
+        return self.poly_.get_feature_names_out(input_features)
+
+
+class SelectUpToKBest(SelectKBest):
+    """
+    SelectKBest that keeps every feature when k is larger than the number of
+    features. The k sliders are set before the feature count is known (it
+    depends on the one-hot and polynomial expansion), and plain SelectKBest
+    raises for those candidates in some sklearn versions.
+    """
+
+    def _check_params(self, X, y):
+        if not isinstance(self.k, str) and self.k > X.shape[1]:
+            return  # the support mask then covers every feature
+        super()._check_params(X, y)
@@ -0,0 +1,61 @@
+'''
+Hold-out evaluation of a fitted pipeline on the test split.
+
+The test rows are predicted in fixed-size batches, and each batch only
+contributes its four confusion counts (one bincount), so memory is bounded
+by one batch of transformed features per worker however large the test set
+is. Batches can run on several threads: the estimator is shared, not
+copied, and numpy and the sklearn models release the GIL for most of the
+work.
+'''
+
+import time
+import tracemalloc
+
+import numpy as np
+from joblib import Parallel, delayed
+
+from scoring import confusion_counts, metrics_from_counts
+
+HOLDOUT_BATCH_ROWS = 10_000
+
+
+def _batch_counts(estimator, X, y, start, stop):
+    return np.array(confusion_counts(y[start:stop], estimator.predict(X.iloc[start:stop])))
+
+
+def evaluate_holdout(estimator, X, y, batch_rows=HOLDOUT_BATCH_ROWS, n_jobs=1, trace_memory=False):
+    """
+    Profit, F1, precision and recall of `estimator` on (X, y), with the
+    confusion counts, throughput in rows/s and, with trace_memory, the peak
+    memory Python allocated while scoring (tracemalloc, which numpy reports
+    to). tracemalloc is process-wide: only trace in a process of its own,
+    like benchmarks.py, never inside the app server.
+    """
+    y = np.asarray(y)
+    bounds = [(start, min(start + batch_rows, len(X))) for start in range(0, len(X), batch_rows)]
+
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        counts = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(_batch_counts)(estimator, X, y, start, stop) for start, stop in bounds
+        )
+        seconds = time.perf_counter() - start_time
+        peak_bytes = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    tn, fp, fn, tp = (int(c) for c in np.sum(counts, axis=0)) if counts else (0, 0, 0, 0)
+    return {
+        "metrics": metrics_from_counts(tn, fp, fn, tp),
+        "counts": {"tn": tn, "fp": fp, "fn": fn, "tp": tp},
+        "rows": len(X),
+        "seconds": seconds,
+        "rows_per_second": len(X) / seconds if seconds > 0 else float("inf"),
+        "peak_bytes": peak_bytes,
+        "batch_rows": batch_rows,
+        "n_jobs": n_jobs,
+    }
@@ -0,0 +1,121 @@
+'''
+Background execution of model fits for the Custom Model Builder.
+
+Streamlit reruns the script on every widget change, so fits are submitted as
+jobs to a process-wide thread pool instead of running inline. A job reports
+progress and watches for cancellation through files in its own directory:
+JobProgress (and JobScorer, which wraps a scorer with it) appends a byte
+per scored (candidate, fold) and raises JobCancelled once the cancel marker
+exists. Files keep this working when the search itself fans out to worker
+processes.
+'''
+
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from search import _bump, _read_count
+
+JOB_DIR = os.environ.get("LOAN_APP_JOB_DIR", ".cache/jobs")
+# searches that may run at once on this server
+MAX_JOBS = int(os.environ.get("LOAN_APP_MAX_JOBS", 2))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress:
+    """
+    The picklable half of a job: what fitting code, possibly in a worker
+    process, uses to report progress and notice cancellation.
+    """
+
+    def __init__(self, progress_path, cancel_path):
+        self.progress_path = progress_path
+        self.cancel_path = cancel_path
+
+    def tick(self, n=1):
+        for _ in range(n):
+            _bump(self.progress_path)
+
+    def check_cancelled(self):
+        if os.path.exists(self.cancel_path):
+            raise JobCancelled()
+
+
+class JobScorer(JobProgress):
+    """Wraps a scoring callable to report progress and honour cancellation."""
+
+    def __init__(self, scoring, progress_path, cancel_path):
+        super().__init__(progress_path, cancel_path)
+        self.scoring = scoring
+
+    def __call__(self, estimator, X, y):
+        self.check_cancelled()
+        scores = self.scoring(estimator, X, y)
+        self.tick()
+        return scores
+
+
+class FitJob:
+    """
+    One submitted search. `total` is the number of (candidate, fold) fits it
+    will score; `config` is whatever the caller wants back with the result.
+    """
+
+    def __init__(self, total, config=None, workdir=JOB_DIR):
+        self.id = uuid.uuid4().hex
+        self.total = total
+        self.config = config
+        self.dir = os.path.join(workdir, self.id)
+        os.makedirs(self.dir, exist_ok=True)
+        self.progress_path = os.path.join(self.dir, "progress")
+        self.cancel_path = os.path.join(self.dir, "cancel")
+        self.started = time.time()
+        self.future = None
+
+    def wrap_scoring(self, scoring):
+        return JobScorer(scoring, self.progress_path, self.cancel_path)
+
+    def reporter(self):
+        return JobProgress(self.progress_path, self.cancel_path)
+
+    def done_count(self):
+        return min(_read_count(self.progress_path), self.total)
+
+    def eta(self):
+        """Seconds left at the rate so far, or None before the first fit."""
+        done = self.done_count()
+        if done == 0:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed / done * (self.total - done)
+
+    def cancel(self):
+        open(self.cancel_path, "w").close()
+        self.future.cancel()
+
+    def running(self):
+        return not self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class JobRunner:
+    """Process-wide pool that runs fn(job) for each submitted job."""
+
+    def __init__(self, max_jobs=MAX_JOBS, workdir=JOB_DIR):
+        self.workdir = workdir
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="fit-job")
+
+    def submit(self, total, fn, config=None):
+        job = FitJob(total, config=config, workdir=self.workdir)
+        job.future = self.executor.submit(fn, job)
+        return job
@@ -0,0 +1,91 @@
+'''
+Load test for scoring_service.py.
+
+    python scoring_service.py MODEL &
+    python load_test.py [--url http://127.0.0.1:8000] [--requests 2000]
+                        [--concurrency 16] [--batch 1]
+
+Sends --requests POST /score calls from --concurrency client threads, each
+carrying --batch loan applications drawn from the hold-out split (the rows
+the leaderboard models never trained on), then prints the client-side
+latency percentiles and throughput next to the service's own /metrics.
+'''
+
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from loan_data import load_loans, split_loans
+
+
+def sample_records(n, seed=0):
+    """n raw loan records from the hold-out split, as JSON-ready dicts."""
+    _, X_test, _, _ = split_loans(load_loans())
+    sample = X_test.sample(n=min(n, len(X_test)), random_state=seed)
+    # to_json maps NaN to null and categoricals to their values
+    return json.loads(sample.to_json(orient="records"))
+
+
+def _post(url, payload):
+    # (seconds, succeeded)
+    request = urllib.request.Request(url, data=payload, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        e.read()
+        return time.perf_counter() - start, False
+    return time.perf_counter() - start, True
+
+
+def run(url, n_requests, concurrency, batch):
+    records = sample_records(max(n_requests * batch, 1))
+    payloads = []
+    for i in range(n_requests):
+        chunk = [records[(i * batch + j) % len(records)] for j in range(batch)]
+        payloads.append(json.dumps(chunk[0] if batch == 1 else chunk).encode())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda payload: _post(url + "/score", payload), payloads))
+    seconds = time.perf_counter() - start
+    latencies = np.array([latency for latency, _ in results]) * 1000
+
+    with urllib.request.urlopen(url + "/metrics") as response:
+        service = json.load(response)
+    return {
+        "requests": n_requests,
+        "errors": sum(not ok for _, ok in results),
+        "seconds": seconds,
+        "requests_per_second": n_requests / seconds,
+        "records_per_second": n_requests * batch / seconds,
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p99": float(np.percentile(latencies, 99)),
+        "latency_ms_max": float(latencies.max()),
+    }, service
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test a running scoring_service.py.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=2000, help="POST /score calls to send (default 2000)")
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads (default 16)")
+    parser.add_argument("--batch", type=int, default=1, help="applications per request (default 1)")
+    args = parser.parse_args(argv)
+
+    client, service = run(args.url.rstrip("/"), args.requests, args.concurrency, args.batch)
+    print(f"client:  {client['requests']:,} requests ({client['errors']:,} failed) in {client['seconds']:.2f}s, "
+          f"{client['requests_per_second']:,.0f} req/s, {client['records_per_second']:,.0f} records/s")
+    print(f"         latency p50 {client['latency_ms_p50']:.1f} ms, p99 {client['latency_ms_p99']:.1f} ms, "
+          f"max {client['latency_ms_max']:.1f} ms")
+    print(f"service: {json.dumps(service)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+'''
+Loading the loan data used by app.py.
+
+Parsing inputs/final_2013_subsample.csv takes most of the time of a Streamlit
+rerun, so the CSV is converted once into a typed Parquet file (object columns
+stored as categoricals) next to it. Later loads read the Parquet file with
+memory mapping, and app.py keeps the resulting split in a process-wide cache.
+The Parquet file is rebuilt whenever the CSV is newer than it.
+'''
+
+import os
+
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+DATA_CSV = "inputs/final_2013_subsample.csv"
+DATA_CACHE = "inputs/final_2013_subsample.parquet"
+
+
+def build_columnar_cache(csv_path=DATA_CSV, cache_path=DATA_CACHE):
+    """
+    Parse the CSV once and write it to cache_path as Parquet. The loan id
+    becomes the index (it is an identifier, not a feature) and text columns
+    become categoricals.
+    """
+    loans = pd.read_csv(csv_path)
+    loans = loans.set_index("id")
+
+    for col in loans.select_dtypes(include="object").columns:
+        loans[col] = loans[col].astype("category")
+
+    # write to a temp file first so a concurrent reader never sees half a file
+    tmp_path = cache_path + ".tmp"
+    loans.to_parquet(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return loans
+
+
+def load_loans(csv_path=DATA_CSV, cache_path=DATA_CACHE):
+    """
+    Return the loan data, rebuilding the Parquet cache if it is missing or
+    older than the CSV. Without the CSV (a deployment shipping only the
+    cache) the cache is used as is.
+    """
+    stale = (
+        not os.path.exists(cache_path)
+        or (os.path.exists(csv_path) and os.path.getmtime(cache_path) < os.path.getmtime(csv_path))
+    )
+    if stale:
+        return build_columnar_cache(csv_path, cache_path)
+    return pd.read_parquet(cache_path, memory_map=True)
+
+
+def split_loans(loans):
+    """
+    Same holdout split app.py has always used: stratified 80/20 on the
+    charged-off flag with random_state=0.
+    """
+    y = loans.loan_status == "Charged Off"
+    X = loans.drop("loan_status", axis=1)
+
+    # (stratify will make sure that test/train both have equal fractions of outcome)
+    return train_test_split(X, y, stratify=y, test_size=0.2, random_state=0)
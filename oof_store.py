@@ -0,0 +1,98 @@
+'''
+Out-of-fold decision scores of a search's candidates.
+
+While a search cross-validates, every (candidate, fold) evaluation writes
+the positive-class scores of the test fold, keyed by loan id, to a small
+file named after the candidate's parameters. Once the best candidate is
+known its files are stitched into one float32 array over the training
+rows: scores from models that never saw those rows, which the results view
+uses for its diagnostics and for choosing a decision threshold without
+refitting. Files work across the worker processes a search fans out to,
+like the job progress counters in jobs.py.
+'''
+
+import hashlib
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from scoring import decision_scores, loan_metrics
+
+
+def params_digest(params):
+    return hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()
+
+
+class OOFRecorder:
+    """Writes and stitches the out-of-fold scores under `directory`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, params, ids, scores, threshold):
+        folder = os.path.join(self.directory, params_digest(params))
+        os.makedirs(folder, exist_ok=True)
+        # time-ordered names: when a candidate is scored again on more rows
+        # (successive halving), the later scores win when stitching
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+        tmp_path = os.path.join(folder, name + ".part.npz")
+        np.savez(
+            tmp_path,
+            ids=np.asarray(ids),
+            scores=np.asarray(scores, dtype=np.float32),
+            threshold=np.float64(threshold),
+        )
+        os.replace(tmp_path, os.path.join(folder, name + ".npz"))
+
+    def scorer(self, param_names, metrics=loan_metrics):
+        return OOFScorer(self, param_names, metrics)
+
+    def collect(self, params, index):
+        """
+        (scores, threshold) of the candidate with `params`: float32 scores in
+        the order of `index` (NaN for rows it was never scored on) and the
+        cutoff its predict() applies. None if it recorded nothing.
+        """
+        folder = os.path.join(self.directory, params_digest(params))
+        if not os.path.isdir(folder):
+            return None
+        names = sorted(name for name in os.listdir(folder) if name.endswith(".npz") and not name.endswith(".part.npz"))
+        if not names:
+            return None
+
+        scores = np.full(len(index), np.nan, dtype=np.float32)
+        threshold = None
+        for name in names:
+            with np.load(os.path.join(folder, name)) as part:
+                positions = index.get_indexer(part["ids"])
+                known = positions >= 0
+                scores[positions[known]] = part["scores"][known]
+                threshold = float(part["threshold"])
+        return scores, threshold
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class OOFScorer:
+    """
+    Multi-metric scorer like loan_scorer that also records the fold's
+    scores. The predictions come from the same decision scores (`scores >
+    cutoff` is what predict() does), so it still costs one pass per fold.
+    `param_names` are the searched parameters that identify a candidate.
+    """
+
+    def __init__(self, recorder, param_names, metrics=loan_metrics):
+        self.recorder = recorder
+        self.param_names = list(param_names)
+        self.metrics = metrics
+
+    def __call__(self, estimator, X, y):
+        scores, threshold = decision_scores(estimator, X)
+        params = estimator.get_params()
+        self.recorder.record({name: params[name] for name in self.param_names}, X.index, scores, threshold)
+        return self.metrics(y, scores > threshold)
@@ -0,0 +1,576 @@
+'''
+Shared-path evaluation of a create_pipeline grid.
+
+GridSearchCV treats every candidate as an independent fit. Most of the
+grids the Custom Model Builder produces do not need that. Candidates that
+differ only in the classifier's hyperparameter can share the transformed
+fold, and several hyperparameters have a "path" where one computation
+answers every value (one neighbor table serves every n_neighbors, for
+example).
+
+PathSearch walks each fold once:
+
+    fit columntransformer + feature_create      once per fold
+    for each feature_select setting             via SELECTOR_PATHS
+        for each classifier setting             via CLF_PATHS
+
+and scores every candidate from the decision scores the paths return. The
+results have GridSearchCV's cv_results_ layout. Steps without a registered
+path fall back to fitting each setting separately, so any grid works, only
+without the sharing.
+'''
+
+import numbers
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import clone, is_classifier
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_selection import RFECV, SelectKBest, SequentialFeatureSelector
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import ParameterGrid, check_cv, cross_val_score
+from sklearn.neighbors import KNeighborsClassifier, NearestNeighbors
+from sklearn.pipeline import Pipeline
+from sklearn.svm import LinearSVC
+from sklearn.tree import DecisionTreeClassifier
+
+from scoring import REFIT_METRIC, decision_scores, loan_metrics
+from search import build_cv_results
+
+# nearest-neighbor index choices for the KNN path; the trees do not take sparse input
+KNN_INDEXES = ["brute", "kd_tree", "ball_tree", "nndescent"]
+
+
+def _split_params(params, step):
+    prefix = step + "__"
+    return {name[len(prefix):]: value for name, value in params.items() if name.startswith(prefix)}
+
+
+def _key(params):
+    return tuple(sorted(params.items()))
+
+
+def _distinct(param_sets):
+    # unique parameter dicts, in first-seen order
+    seen = {}
+    for params in param_sets:
+        seen.setdefault(_key(params), params)
+    return list(seen.values())
+
+
+################################ classifier paths ################################
+# A classifier path gets the transformed training and test fold and a list of
+# parameter dicts for the clf step, and returns the positive-class scores on
+# the test fold for each dict, in order.
+
+def _generic_clf_path(clf, X_train, y_train, X_test, param_sets, options):
+    scores = []
+    for params in param_sets:
+        model = clone(clf).set_params(**params).fit(X_train, y_train)
+        scores.append(decision_scores(model, X_test)[0])
+    return scores
+
+
+def _knn_path(clf, X_train, y_train, X_test, param_sets, options):
+    """
+    One k_max neighbor query per fold. The vote share among the first k
+    neighbors is predict_proba for n_neighbors=k, for every k at once.
+    """
+    if clf.weights != "uniform" or any(set(params) - {"n_neighbors"} for params in param_sets):
+        return _generic_clf_path(clf, X_train, y_train, X_test, param_sets, options)
+
+    ks = [params.get("n_neighbors", clf.n_neighbors) for params in param_sets]
+    k_max = max(ks)
+    neighbors = _neighbor_table(clf, X_train, X_test, k_max, options.get("knn_index", "brute"))
+
+    # positives among the first k neighbors, for k = 1..k_max
+    votes = np.cumsum(np.asarray(y_train, dtype=np.int32)[neighbors], axis=1)
+    return [votes[:, k - 1] / k for k in ks]
+
+
+def _neighbor_table(clf, X_train, X_test, k, index):
+    if index == "nndescent":
+        try:
+            from pynndescent import NNDescent
+        except ImportError:
+            raise ImportError("the nndescent index needs the pynndescent package") from None
+        graph = NNDescent(X_train, n_neighbors=max(k, 15), metric="euclidean", random_state=0)
+        neighbors, _ = graph.query(X_test, k=k)
+        return neighbors
+
+    if sp.issparse(X_train):
+        index = "brute"
+    nn = NearestNeighbors(
+        n_neighbors=k,
+        algorithm=index,
+        metric=clf.metric,
+        p=clf.p,
+        metric_params=clf.metric_params,
+        n_jobs=clf.n_jobs,
+    )
+    nn.fit(X_train)
+    return nn.kneighbors(X_test, return_distance=False)
+
+
+def _c_path(clf, X_train, y_train, X_test, param_sets, options):
+    """
+    The C grid in increasing order on one fold matrix. LogisticRegression
+    warm-starts each fit from the previous, more regularized, coefficients
+    (same optimum, up to the solver tolerance). liblinear behind LinearSVC
+    has no warm start, so it refits from zero but still reuses the fold.
+    """
+    if any(set(params) - {"C"} for params in param_sets):
+        return _generic_clf_path(clf, X_train, y_train, X_test, param_sets, options)
+
+    model = clone(clf)
+    if isinstance(model, LogisticRegression) and model.solver != "liblinear":
+        model.set_params(warm_start=True)
+
+    Cs = [params.get("C", clf.C) for params in param_sets]
+    scores = [None] * len(Cs)
+    for i in np.argsort(Cs, kind="stable"):
+        model.set_params(C=Cs[i]).fit(X_train, y_train)
+        scores[i] = decision_scores(model, X_test)[0]
+    return scores
+
+
+def _tree_path(clf, X_train, y_train, X_test, param_sets, options):
+    """
+    Grow one tree per fold with the smallest min_samples_split and no depth
+    limit or pruning, then read every candidate off it. A node is a leaf of
+    the candidate's tree when it has fewer samples than that candidate's
+    min_samples_split, sits at its max_depth, or is collapsed by
+    cost-complexity pruning at its ccp_alpha. Ancestors of such a node make
+    the same split either way, so the truncated tree is the tree the
+    candidate would have grown (up to the tie-breaking randomness the tree
+    already has without a fixed random_state).
+    """
+    varying = {"min_samples_split", "max_depth", "ccp_alpha"}
+    candidates = [{name: params.get(name, getattr(clf, name)) for name in varying} for params in param_sets]
+    if (
+        any(set(params) - varying for params in param_sets)
+        or any(isinstance(c["min_samples_split"], float) for c in candidates)
+    ):
+        return _generic_clf_path(clf, X_train, y_train, X_test, param_sets, options)
+
+    tree = clone(clf).set_params(
+        min_samples_split=min(c["min_samples_split"] for c in candidates),
+        max_depth=None,
+        ccp_alpha=0.0,
+    )
+    tree.fit(X_train, y_train)
+    t = tree.tree_
+
+    value = t.value[:, 0, :]
+    proba = value[:, 1] / value.sum(axis=1)
+    is_leaf = t.children_left == -1
+    depth = _node_depth(t)
+
+    # nodes on each test row's root-to-leaf path; node ids grow with depth
+    path = tree.decision_path(X_test).tocsr()
+    path.sort_indices()
+    positions = np.arange(len(path.indices))
+
+    scores = []
+    for c in candidates:
+        leaf = is_leaf | (t.n_node_samples < c["min_samples_split"])
+        if c["max_depth"] is not None:
+            leaf |= depth >= c["max_depth"]
+        if c["ccp_alpha"] > 0:
+            leaf |= _ccp_collapsed(t, c["ccp_alpha"], leaf)
+
+        # the first node on the path that is a leaf of this candidate's tree
+        first = np.minimum.reduceat(np.where(leaf[path.indices], positions, len(positions)), path.indptr[:-1])
+        scores.append(proba[path.indices[first]])
+    return scores
+
+
+def _node_depth(t):
+    depth = np.zeros(t.node_count, dtype=np.int64)
+    for node in range(t.node_count):
+        if t.children_left[node] != -1:
+            depth[t.children_left[node]] = depth[node] + 1
+            depth[t.children_right[node]] = depth[node] + 1
+    return depth
+
+
+def _ccp_collapsed(t, alpha, leaf):
+    """
+    Nodes minimal cost-complexity pruning at `alpha` turns into leaves, given
+    the nodes that already are. Bottom-up: a node is collapsed when its cost
+    as a leaf, R(t) + alpha, is no more than that of its best subtree, which
+    is the same as sklearn's weakest-link rule g(t) <= alpha.
+    """
+    risk = t.impurity * t.weighted_n_node_samples / t.weighted_n_node_samples[0]
+    leaf_cost = risk + alpha
+    best_cost = leaf_cost.copy()
+    collapsed = np.zeros(t.node_count, dtype=bool)
+    # children always have larger ids than their parent
+    for node in range(t.node_count - 1, -1, -1):
+        if leaf[node]:
+            continue
+        children = best_cost[t.children_left[node]] + best_cost[t.children_right[node]]
+        if leaf_cost[node] <= children:
+            collapsed[node] = True
+        else:
+            best_cost[node] = children
+    return collapsed
+
+
+CLF_PATHS = {
+    KNeighborsClassifier: _knn_path,
+    DecisionTreeClassifier: _tree_path,
+    LogisticRegression: _c_path,
+    LinearSVC: _c_path,
+}
+
+
+################################ selector paths ################################
+# A selector path gets the transformed training and test fold and the list of
+# distinct parameter dicts for the feature_select step, and yields
+# (params, selected training fold, selected test fold) for each of them.
+
+def _generic_selector_path(selector, X_train, y_train, X_test, param_sets, options):
+    for params in param_sets:
+        if selector == "passthrough":
+            yield params, X_train, X_test
+            continue
+        fitted = clone(selector).set_params(**params).fit(X_train, y_train)
+        yield params, fitted.transform(X_train), fitted.transform(X_test)
+
+
+def _kbest_path(selector, X_train, y_train, X_test, param_sets, options):
+    """
+    Score the features once per fold and serve every k as a prefix of one
+    ranking, in SelectKBest's own order (NaN scores last, ties to the later
+    column). k larger than the number of features keeps them all.
+    """
+    if any(set(params) - {"k"} for params in param_sets):
+        yield from _generic_selector_path(selector, X_train, y_train, X_test, param_sets, options)
+        return
+
+    scores = selector.score_func(X_train, y_train)
+    scores = np.asarray(scores[0] if isinstance(scores, tuple) else scores, dtype=float)
+    scores = np.where(np.isnan(scores), np.finfo(float).min, scores)
+    ranking = np.argsort(scores, kind="mergesort")[::-1]
+
+    n_features = X_train.shape[1]
+    for params in param_sets:
+        k = params.get("k", selector.k)
+        k = n_features if k == "all" else min(int(k), n_features)
+        columns = np.sort(ranking[:k])  # keep the original column order, like transform()
+        yield params, X_train[:, columns], X_test[:, columns]
+
+
+def _svd_path(selector, X_train, y_train, X_test, param_sets, options):
+    """
+    One TruncatedSVD per fold at the largest requested rank. The first c
+    columns of the projected fold are the c-component projection (the
+    leading singular vectors of a higher-rank randomized SVD are, if
+    anything, more accurate), so every n_components is a slice of one
+    cached matrix. Ranks past the fold's width never get here (see
+    SELECTOR_LIMITS).
+    """
+    if any(set(params) - {"n_components"} for params in param_sets):
+        yield from _generic_selector_path(selector, X_train, y_train, X_test, param_sets, options)
+        return
+
+    ranks = [int(params.get("n_components", selector.n_components)) for params in param_sets]
+    svd = clone(selector).set_params(n_components=max(ranks))
+    projected_train = svd.fit_transform(X_train)
+    projected_test = svd.transform(X_test)
+    for params, rank in zip(param_sets, ranks):
+        yield params, projected_train[:, :rank], projected_test[:, :rank]
+
+
+def _rfecv_path(selector, X_train, y_train, X_test, param_sets, options):
+    """
+    RFECV once per step value and fold. Its nested search (inner folds x
+    elimination rounds) is the whole cost of this selector, and here every
+    classifier setting reuses it instead of rerunning it. Step values that
+    end on the same features are yielded one after another with the very
+    same matrices, which the engine scores only once; only one selection's
+    matrices exist at a time.
+    """
+    by_support = {}
+    for params in param_sets:
+        fitted = clone(selector).set_params(**params).fit(X_train, y_train)
+        by_support.setdefault(fitted.support_.tobytes(), (np.flatnonzero(fitted.support_), []))[1].append(params)
+
+    for columns, settings in by_support.values():
+        Xs_train, Xs_test = X_train[:, columns], X_test[:, columns]
+        for params in settings:
+            yield params, Xs_train, Xs_test
+
+
+def _sfs_path(selector, X_train, y_train, X_test, param_sets, options):
+    """
+    Greedy forward selection run once per fold, up to the largest
+    n_features_to_select. The selection for n is the first n features of
+    that path: each step only depends on the features chosen before it. At
+    each step the remaining features are tried in parallel, scored like
+    SequentialFeatureSelector (mean inner-CV score, ties to the lowest
+    column). Counts SequentialFeatureSelector would reject never get here
+    (see SELECTOR_LIMITS).
+    """
+    if (
+        any(set(params) - {"n_features_to_select"} for params in param_sets)
+        or selector.direction != "forward"
+        or selector.tol is not None
+    ):
+        yield from _generic_selector_path(selector, X_train, y_train, X_test, param_sets, options)
+        return
+
+    n_features = X_train.shape[1]
+    targets = [
+        _sfs_target(params.get("n_features_to_select", selector.n_features_to_select), n_features)
+        for params in param_sets
+    ]
+    cv = check_cv(selector.cv, y_train, classifier=is_classifier(selector.estimator))
+    splits = list(cv.split(X_train, y_train))
+
+    path = []
+    remaining = list(range(n_features))
+    with Parallel(n_jobs=options.get("n_jobs")) as parallel:
+        for _ in range(max(targets)):
+            scores = parallel(
+                delayed(_sfs_trial)(selector.estimator, X_train, y_train, np.sort(path + [feature]), splits, selector.scoring)
+                for feature in remaining
+            )
+            path.append(remaining.pop(int(np.argmax(scores))))
+
+    for params, n in zip(param_sets, targets):
+        columns = np.sort(path[:n])  # column order of transform()
+        yield params, X_train[:, columns], X_test[:, columns]
+
+
+def _sfs_target(n_select, n_features):
+    # the number of features SequentialFeatureSelector(tol=None) selects
+    if n_select in ("auto", "warn", None):
+        return n_features // 2
+    if isinstance(n_select, numbers.Integral):
+        return int(n_select)
+    return int(n_select * n_features)
+
+
+def _sfs_trial(estimator, X, y, columns, splits, scoring):
+    return cross_val_score(clone(estimator), X[:, columns], y, cv=splits, scoring=scoring).mean()
+
+
+SELECTOR_PATHS = {
+    SelectKBest: _kbest_path,
+    TruncatedSVD: _svd_path,
+    RFECV: _rfecv_path,
+    SequentialFeatureSelector: _sfs_path,
+}
+
+
+################################ selector limits ###############################
+# A selector limit gets the selector, one parameter dict and the width of the
+# transformed fold, and returns why sklearn would reject that setting (None
+# if it would not). Rejected settings are not scored: their candidates get
+# NaN scores and rank last in cv_results_, as failed fits do in GridSearchCV,
+# so no score is ever reported for a setting the refit could not use.
+
+def _svd_limit(selector, params, n_features):
+    n_components = int(params.get("n_components", selector.n_components))
+    # TruncatedSVD's own check: randomized allows every column, arpack one fewer
+    algorithm = params.get("algorithm", selector.algorithm)
+    limit = n_features - 1 if algorithm == "arpack" else n_features
+    if n_components > limit:
+        return f"n_components={n_components} is over {limit}, TruncatedSVD's limit for {n_features} features"
+    return None
+
+
+def _sfs_limit(selector, params, n_features):
+    n_select = params.get("n_features_to_select", selector.n_features_to_select)
+    # SequentialFeatureSelector's own check for an explicit count
+    if isinstance(n_select, numbers.Integral) and n_select >= n_features:
+        return f"n_features_to_select={n_select} must be below {n_features}, the number of features"
+    if _sfs_target(n_select, n_features) < 1:
+        return f"n_features_to_select={n_select} selects no feature out of {n_features}"
+    return None
+
+
+SELECTOR_LIMITS = {
+    TruncatedSVD: _svd_limit,
+    SequentialFeatureSelector: _sfs_limit,
+}
+
+
+def _path_for(registry, step, default):
+    # registered path for the step's class or its nearest registered base class
+    for cls in type(step).__mro__:
+        if cls in registry:
+            return registry[cls]
+    return default
+
+
+class PathSearch:
+    """
+    Grid search over a create_pipeline pipeline that shares fitted work
+    between candidates along the paths in CLF_PATHS and SELECTOR_PATHS.
+
+    Same inputs as GridSearchCV (the scores come from `metrics(y, y_pred)`
+    instead of a scorer), and the same cv_results_, best_index_ and refit
+    best_estimator_. `progress`, if given, gets tick(n) as candidates are
+    scored on a fold and check_cancelled() between pieces of work. `oof`, an
+    OOFRecorder (see oof_store.py), gets every candidate's test-fold scores.
+    Candidates whose selector setting does not fit the design matrix (see
+    SELECTOR_LIMITS) score NaN and rank last; out_of_range_ says why.
+    """
+
+    def __init__(self, estimator, param_grid, cv, metrics=loan_metrics, refit=REFIT_METRIC,
+                 n_jobs=None, knn_index="brute", progress=None, oof=None):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.metrics = metrics
+        self.refit = refit
+        self.n_jobs = n_jobs
+        self.knn_index = knn_index
+        self.progress = progress
+        self.oof = oof
+
+    def set_params(self, **params):
+        for name, value in params.items():
+            setattr(self, name, value)
+        return self
+
+    def _options(self, n_folds):
+        # the folds run on up to n_jobs workers; work parallelized inside a
+        # fold (forward-selection trials) shares what is left, so both levels
+        # together stay within n_jobs
+        n_workers = effective_n_jobs(self.n_jobs)
+        return {"knn_index": self.knn_index, "n_jobs": max(1, n_workers // min(n_workers, n_folds))}
+
+    def fit(self, X, y):
+        candidates = list(ParameterGrid(self.param_grid))
+        splits = list(check_cv(self.cv, y, classifier=True).split(X, y))
+
+        options = self._options(len(splits))
+        folds = Parallel(n_jobs=self.n_jobs)(
+            delayed(self._fit_fold)(X, y, train, test, candidates, options) for train, test in splits
+        )
+
+        # candidate index -> why it was not scored on some fold
+        self.out_of_range_ = {i: reason for fold in folds for i, reason in fold["out_of_range"].items()}
+        unscored = np.full(len(candidates), np.nan)
+        fold_scores = {
+            metric: np.column_stack([fold["scores"].get(metric, unscored) for fold in folds])
+            for metric in sorted({metric for fold in folds for metric in fold["scores"]})
+        }
+        if not fold_scores or np.isnan(fold_scores[self.refit].mean(axis=1)).all():
+            raise ValueError("No candidate can be scored: " + "; ".join(sorted(set(self.out_of_range_.values()))))
+        fit_times = np.column_stack([fold["fit_time"] for fold in folds])
+        score_times = np.column_stack([fold["score_time"] for fold in folds])
+        self.cv_results_ = build_cv_results(candidates, fold_scores, fit_times, score_times)
+
+        self.best_index_ = int(np.nanargmax(self.cv_results_[f"mean_test_{self.refit}"]))
+        self.best_params_ = candidates[self.best_index_]
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(X, y)
+        return self
+
+    def _fit_fold(self, X, y, train, test, candidates, options):
+        steps = self.estimator.steps
+        prefix_steps, (select_name, selector), (clf_name, clf) = steps[:-2], steps[-2], steps[-1]
+        prefix_names = [name for name, _ in prefix_steps]
+
+        X_train, X_test = X.iloc[train], X.iloc[test]
+        y_train, y_test = np.asarray(y)[train], np.asarray(y)[test]
+
+        n = len(candidates)
+        metrics = {}
+        out_of_range = {}
+        fit_time = np.zeros(n)
+        score_time = np.zeros(n)
+
+        # candidates that agree on the preprocessing share one fitted prefix
+        groups = {}
+        for i, params in enumerate(candidates):
+            prefix_params = {k: v for k, v in params.items() if k.split("__")[0] in prefix_names}
+            groups.setdefault(_key(prefix_params), (prefix_params, []))[1].append(i)
+
+        threshold = _threshold(clf)
+        for prefix_params, members in groups.values():
+            self._check_cancelled()
+            start = time.perf_counter()
+            prefix = clone(Pipeline(prefix_steps)).set_params(**prefix_params)
+            Xt_train = prefix.fit_transform(X_train, y_train)
+            Xt_test = prefix.transform(X_test)
+            # shared work is charged evenly to the candidates that share it
+            fit_time[members] += (time.perf_counter() - start) / len(members)
+
+            by_selector = {}
+            for i in members:
+                by_selector.setdefault(_key(_split_params(candidates[i], select_name)), []).append(i)
+            selector_sets = _distinct(_split_params(candidates[i], select_name) for i in members)
+            limit = _path_for(SELECTOR_LIMITS, selector, None)
+            if limit is not None:
+                scorable = []
+                for select_params in selector_sets:
+                    reason = limit(selector, select_params, Xt_train.shape[1])
+                    if reason is None:
+                        scorable.append(select_params)
+                        continue
+                    rows = by_selector[_key(select_params)]
+                    out_of_range.update((i, reason) for i in rows)
+                    self._tick(len(rows))
+                selector_sets = scorable
+            selector_path = _path_for(SELECTOR_PATHS, selector, _generic_selector_path)
+            clf_path = _path_for(CLF_PATHS, clf, _generic_clf_path)
+
+            # a selector path yields the same matrices for consecutive settings
+            # that select the same features; their classifier scores are reused.
+            # Only the last matrices are held (which keeps their ids unique), so
+            # each is freed once the next selection arrives.
+            last_key = last_matrices = scores = None
+            start = time.perf_counter()
+            for select_params, Xs_train, Xs_test in selector_path(
+                selector, Xt_train, y_train, Xt_test, selector_sets, options
+            ):
+                self._check_cancelled()
+                rows = by_selector[_key(select_params)]
+                clf_sets = [_split_params(candidates[i], clf_name) for i in rows]
+                result_key = (id(Xs_train), id(Xs_test), tuple(_key(params) for params in clf_sets))
+                if result_key != last_key:
+                    last_matrices = None  # free the previous selection first
+                    scores = clf_path(clf, Xs_train, y_train, Xs_test, clf_sets, options)
+                    last_key, last_matrices = result_key, (Xs_train, Xs_test)
+                del Xs_train, Xs_test
+                fit_time[rows] += (time.perf_counter() - start) / len(rows)
+
+                for i, candidate_scores in zip(rows, scores):
+                    score_start = time.perf_counter()
+                    values = self.metrics(y_test, candidate_scores > threshold)
+                    if self.oof is not None:
+                        self.oof.record(candidates[i], X_test.index, candidate_scores, threshold)
+                    for metric, value in values.items():
+                        metrics.setdefault(metric, np.full(n, np.nan))[i] = value
+                    score_time[i] = time.perf_counter() - score_start
+                self._tick(len(rows))
+                start = time.perf_counter()
+            last_matrices = None  # nor into the next preprocessing group
+
+        return {"scores": metrics, "fit_time": fit_time, "score_time": score_time, "out_of_range": out_of_range}
+
+    def _tick(self, n):
+        if self.progress is not None:
+            self.progress.tick(n)
+
+    def _check_cancelled(self):
+        if self.progress is not None:
+            self.progress.check_cancelled()
+
+    def n_fits(self, n_samples):
+        return len(ParameterGrid(self.param_grid)) * self.cv.get_n_splits()
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+def _threshold(clf):
+    # the cutoff decision_scores() pairs with this kind of classifier
+    return 0.0 if hasattr(clf, "decision_function") else 0.5
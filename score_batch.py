@@ -0,0 +1,160 @@
+'''
+Score a file of loan applications with a pipeline from the Custom Model
+Builder.
+
+    python score_batch.py MODEL INPUT OUTPUT [--chunksize N] [--workers N]
+
+MODEL is a model artifact (a leaderboard row's Artifact path or its
+configuration key, see artifacts.py), any joblib file holding a fitted
+pipeline, or a stored search result, whose best estimator is used. INPUT
+is a CSV or Parquet file with the raw loan columns; OUTPUT (CSV, or Parquet
+by extension) gets one row per input row: the `id` column when the input
+has one, the model's decision `score` and the 0/1 `prediction`.
+
+The input is read in chunks and the chunks are spread over a process pool.
+Each worker loads the model once, and results are written in input order as
+soon as they are ready, so memory holds a few chunks, not the whole file.
+'''
+
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from artifacts import load_artifact
+from scoring import decision_scores
+
+# the model each worker process loaded in _init_worker
+_MODEL = None
+
+
+def _init_worker(model_ref):
+    global _MODEL
+    # memory-mapped: the workers share the model's arrays
+    _MODEL = load_artifact(model_ref)
+
+
+def score_frame(model, frame):
+    """id (if present), float32 score and int8 prediction for each row of frame."""
+    if frame.empty:
+        # sklearn refuses to predict on zero rows
+        scores, threshold = np.array([], dtype=np.float32), 0.0
+    else:
+        scores, threshold = decision_scores(model, frame)
+    out = pd.DataFrame({
+        "score": np.asarray(scores, dtype=np.float32),
+        "prediction": (np.asarray(scores) > threshold).astype(np.int8),
+    })
+    if "id" in frame.columns:
+        out.insert(0, "id", frame["id"].to_numpy())
+    return out
+
+
+def _score_chunk(frame):
+    return score_frame(_MODEL, frame)
+
+
+def read_chunks(path, chunksize):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+
+# columns of an empty output
+EMPTY_OUTPUT = pd.DataFrame({"score": np.array([], dtype=np.float32), "prediction": np.array([], dtype=np.int8)})
+
+
+class ChunkWriter:
+    """Appends scored chunks to a CSV or Parquet file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self.writer = None
+        self.tmp_path = path + ".part"
+
+    def write(self, frame):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.tmp_path, table.schema)
+            self.writer.write_table(table)
+        else:
+            frame.to_csv(self.tmp_path, mode="a" if self.writer else "w", header=not self.writer, index=False)
+            self.writer = True
+
+    def close(self):
+        if self.writer is None:
+            self.write(EMPTY_OUTPUT)  # no rows: still a file with the header
+        if self.parquet:
+            self.writer.close()
+        # the output only appears once it is complete
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.parquet and self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def score_file(model_path, input_path, output_path, chunksize=50_000, workers=None, log=sys.stderr):
+    """Score input_path into output_path; returns (rows, seconds)."""
+    workers = workers or os.cpu_count() or 1
+    writer = ChunkWriter(output_path)
+    rows = 0
+    start = time.perf_counter()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_path,)) as pool:
+            pending = deque()
+
+            def write_oldest():
+                nonlocal rows
+                scored = pending.popleft().result()
+                writer.write(scored)
+                rows += len(scored)
+                elapsed = time.perf_counter() - start
+                print(f"{rows:,} rows scored, {rows / elapsed:,.0f} rows/s", file=log)
+
+            for chunk in read_chunks(input_path, chunksize):
+                pending.append(pool.submit(_score_chunk, chunk))
+                # a couple of chunks queued per worker keeps them busy without reading ahead of the writer
+                if len(pending) >= 2 * workers:
+                    write_oldest()
+            while pending:
+                write_oldest()
+        writer.close()
+    except BaseException:
+        writer.abort()  # no half-written OUTPUT.part left behind
+        raise
+    return rows, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score loan applications with a saved Custom Model Builder pipeline.")
+    parser.add_argument("model", help="model artifact path or key, or a joblib file with a fitted pipeline")
+    parser.add_argument("input", help="CSV or Parquet file of loan applications")
+    parser.add_argument("output", help="where to write id, score and prediction (CSV, or Parquet by extension)")
+    parser.add_argument("--chunksize", type=int, default=50_000, help="rows per chunk (default 50000)")
+    parser.add_argument("--workers", type=int, default=None, help="scoring processes (default: one per core)")
+    args = parser.parse_args(argv)
+
+    rows, seconds = score_file(args.model, args.input, args.output, args.chunksize, args.workers)
+    print(f"done: {rows:,} rows in {seconds:.1f}s ({rows / seconds if seconds else 0:,.0f} rows/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
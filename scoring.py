@@ -0,0 +1,153 @@
+'''
+Scoring functions shared by app.py and the helper modules.
+
+Everything here works from the 2x2 confusion matrix, which is computed in a
+single vectorized pass, so the profit score and the classification metrics
+cost one predict per fold between them.
+'''
+
+import numpy as np
+from sklearn.metrics import make_scorer
+
+# metric whose best candidate GridSearchCV refits
+REFIT_METRIC = "profit"
+
+
+def confusion_counts(y, y_pred):
+    """
+    Return (TN, FP, FN, TP) for boolean or 0/1 labels. Each row is mapped to
+    2*y + y_pred, so one bincount gives the whole matrix.
+    """
+    y = np.asarray(y).ravel().astype(np.intp)
+    y_pred = np.asarray(y_pred).ravel().astype(np.intp)
+    tn, fp, fn, tp = np.bincount(2 * y + y_pred, minlength=4)
+    return tn, fp, fn, tp
+
+
+def profit_from_counts(tn, fn, roa=0.02, haircut=0.20):
+    return tn * roa - fn * haircut
+
+
+# define the profit function
+def custom_prof_score(y, y_pred, roa=0.02, haircut=0.20):
+    """
+    Firm profit is this times the average loan size. We can
+    ignore that term for the purposes of maximization.
+    """
+    tn, fp, fn, tp = confusion_counts(y, y_pred)
+    # TN: loans made and actually paid back, FN: loans made and actually defaulting
+    return profit_from_counts(tn, fn, roa, haircut)
+
+
+# so that we can use the fcn in sklearn, "make a scorer" out of that function
+prof_score = make_scorer(custom_prof_score)
+
+
+def metrics_from_counts(tn, fp, fn, tp, roa=0.02, haircut=0.20):
+    """
+    Profit plus precision, recall and F1 of the positive (charged off) class.
+    Empty denominators give 0, like sklearn's zero_division default.
+    """
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else 0.0
+    return {
+        "profit": float(profit_from_counts(tn, fn, roa, haircut)),
+        "f1": float(f1),
+        "precision": float(precision),
+        "recall": float(recall),
+    }
+
+
+def report_from_counts(tn, fp, fn, tp):
+    """
+    classification_report(..., output_dict=True) for boolean labels, built
+    from the confusion counts instead of another pass over the data.
+    """
+    def _ratio(num, den):
+        return float(num / den) if den else 0.0
+
+    report = {}
+    for label, hit, false_alarm, miss in [("False", tn, fn, fp), ("True", tp, fp, fn)]:
+        report[label] = {
+            "precision": _ratio(hit, hit + false_alarm),
+            "recall": _ratio(hit, hit + miss),
+            "f1-score": _ratio(2 * hit, 2 * hit + false_alarm + miss),
+            "support": int(hit + miss),
+        }
+    report["accuracy"] = _ratio(tn + tp, tn + fp + fn + tp)
+    return report
+
+
+def loan_metrics(y, y_pred, roa=0.02, haircut=0.20):
+    return metrics_from_counts(*confusion_counts(y, y_pred), roa=roa, haircut=haircut)
+
+
+def loan_scorer(estimator, X, y):
+    """
+    Multi-metric scorer for GridSearchCV's `scoring`: one predict, one
+    confusion matrix, every metric. Use with refit=REFIT_METRIC.
+    """
+    return loan_metrics(y, estimator.predict(X))
+
+
+def decision_scores(estimator, X):
+    """
+    Continuous positive-class scores and the cutoff predict() applies to them:
+    decision_function > 0 where the model has one, else predict_proba > 0.5
+    (KNN and trees break a 0.5 tie towards the negative class too).
+    """
+    if hasattr(estimator, "decision_function"):
+        return np.asarray(estimator.decision_function(X)), 0.0
+    return estimator.predict_proba(X)[:, 1], 0.5
+
+
+def threshold_sweep(y, scores, roa=0.02, haircut=0.20):
+    """
+    Profit, precision and recall of the rule `scores > threshold` at every
+    cutoff that changes a prediction, from one sort and cumulative sums
+    (O(n log n) instead of a confusion matrix per cutoff). Cutoffs sit
+    halfway between consecutive distinct scores; the first flags nothing
+    and the last (-inf) flags every loan. Rows with a NaN score are left
+    out. Precision with nothing flagged is 1, as in precision_recall_curve.
+    """
+    y = np.asarray(y).ravel().astype(bool)
+    scores = np.asarray(scores, dtype=np.float64).ravel()
+    scored = ~np.isnan(scores)
+    y, scores = y[scored], scores[scored]
+
+    order = np.argsort(-scores, kind="mergesort")
+    scores, y = scores[order], y[order]
+    # flag the top i rows, for every i where the score changes (and none, and all)
+    cuts = np.concatenate([[0], np.flatnonzero(np.diff(scores) < 0) + 1, [len(scores)]])
+    cuts = np.unique(cuts)
+
+    tp = np.concatenate([[0], np.cumsum(y)])[cuts]
+    fp = cuts - tp
+    positives = y.sum()
+    negatives = len(y) - positives
+    tn = negatives - fp
+    fn = positives - tp
+
+    thresholds = np.empty(len(cuts))
+    inner = (cuts > 0) & (cuts < len(scores))
+    thresholds[inner] = (scores[cuts[inner] - 1] + scores[cuts[inner]]) / 2
+    thresholds[cuts == 0] = scores[0] if len(scores) else 0.0
+    thresholds[cuts == len(scores)] = -np.inf
+
+    flagged = tp + fp
+    precision = np.divide(tp, flagged, out=np.ones(len(cuts)), where=flagged > 0)
+    recall = np.divide(tp, positives, out=np.zeros(len(cuts)), where=positives > 0)
+    return {
+        "threshold": thresholds,
+        "profit": profit_from_counts(tn, fn, roa, haircut).astype(np.float64),
+        "precision": precision,
+        "recall": recall,
+    }
+
+
+def best_threshold(y, scores, roa=0.02, haircut=0.20):
+    """(cutoff, profit) of the most profitable `scores > cutoff` rule."""
+    sweep = threshold_sweep(y, scores, roa, haircut)
+    best = int(np.argmax(sweep["profit"]))
+    return float(sweep["threshold"][best]), float(sweep["profit"][best])
@@ -0,0 +1,291 @@
+'''
+Local HTTP service that scores loan applications with a saved pipeline.
+
+    python scoring_service.py MODEL [--host 127.0.0.1] [--port 8000]
+                              [--max-batch 64] [--max-records 1024]
+                              [--max-wait-ms 2]
+
+MODEL is anything score_batch.py accepts (an artifact path or key, see
+artifacts.py). The model is loaded once and stays in memory.
+
+    POST /score    one JSON loan record, a list of them, or {"records": [...]},
+                   with the raw columns (int_rate, grade, zip_code, ...).
+                   Missing columns are treated as missing values and extra
+                   ones are ignored. Answers {"score": s, "prediction": p},
+                   or {"scores": [...], "predictions": [...]} for several.
+                   More than --max-records records in one request get 413.
+    GET  /metrics  request latency p50/p99 (ms), throughput, errors and
+                   batch sizes
+    GET  /health   {"status": "ok"}
+
+Requests are handled on their own threads, but scoring is not: they queue
+their records for one batching thread, which waits up to --max-wait-ms
+after the first request for others to arrive and scores up to --max-batch
+requests (and --max-records records) with a single vectorized pipeline
+call. Under concurrent load that replaces many small predict calls
+(dominated by per-call overhead in the pipeline) with a few larger ones. If
+the combined call fails, each request in it is scored on its own, so a bad
+record only fails the request that sent it.
+'''
+
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+
+from artifacts import load_artifact
+from features import OneHotBlockEncoder, PairInteractions
+from scoring import decision_scores
+
+# requests whose latency the percentiles are computed over
+LATENCY_WINDOW = 10_000
+# seconds of completed requests the throughput is averaged over
+THROUGHPUT_WINDOW = 60
+
+
+def _numeric_columns(pipe):
+    """Input columns the fitted create_pipeline pipeline treats as numbers."""
+    numeric = set()
+    for _, transformer, columns in pipe.named_steps["columntransformer"].transformers_:
+        last = transformer.steps[-1][1] if isinstance(transformer, Pipeline) else transformer
+        if isinstance(last, PairInteractions):
+            numeric.update(last.numeric_)
+        elif not isinstance(last, (str, OneHotBlockEncoder)) and not hasattr(last, "categories_"):
+            numeric.update(columns)
+    return numeric
+
+
+class ModelScorer:
+    """The loaded pipeline, and how raw JSON records become its input frame."""
+
+    def __init__(self, model_ref):
+        self.model = load_artifact(model_ref)
+        self.columns = list(self.model.feature_names_in_)
+        self.numeric = _numeric_columns(self.model)
+
+    def frame(self, records):
+        X = pd.DataFrame.from_records(records).reindex(columns=self.columns)
+        for col in self.columns:
+            if col in self.numeric:
+                X[col] = pd.to_numeric(X[col], errors="coerce").astype(np.float64)
+            else:
+                X[col] = X[col].astype(object)
+        return X
+
+    def score(self, records):
+        scores, threshold = decision_scores(self.model, self.frame(records))
+        scores = np.asarray(scores, dtype=np.float64)
+        return scores, scores > threshold
+
+
+class MicroBatcher:
+    """
+    Collects the records of concurrent requests and scores them together on
+    one background thread. submit() returns a Future of (scores, predictions)
+    for the request's records. A batch holds at most max_batch requests and,
+    past its first request, max_records records.
+    """
+
+    def __init__(self, scorer, max_batch=64, max_records=1024, max_wait=0.002):
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.max_records = max_records
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.carry = None  # the request that did not fit in the last batch
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, records):
+        future = Future()
+        self.queue.put((records, future))
+        return future
+
+    def _collect(self):
+        first, self.carry = self.carry or self.queue.get(), None
+        batch = [first]
+        n_records = len(first[0])
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if n_records + len(item[0]) > self.max_records:
+                self.carry = item  # starts the next batch
+                break
+            batch.append(item)
+            n_records += len(item[0])
+        return batch
+
+    def _score_each(self, batch):
+        # the combined call failed: find the request(s) that broke it
+        for records, future in batch:
+            try:
+                future.set_result(self.scorer.score(records))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            records = [record for request_records, _ in batch for record in request_records]
+            self.batch_sizes.append(len(batch))
+            try:
+                scores, predictions = self.scorer.score(records)
+            except Exception:
+                self._score_each(batch)
+                continue
+
+            start = 0
+            for request_records, future in batch:
+                stop = start + len(request_records)
+                future.set_result((scores[start:stop], predictions[start:stop]))
+                start = stop
+
+
+class ServiceMetrics:
+    """
+    Latency of recent requests and throughput over the last minute. Failed
+    requests count towards the latencies and the error count, not towards
+    throughput.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.completed = deque()  # (finish time, records)
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, seconds, n_records, failed=False):
+        now = time.perf_counter()
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            if failed:
+                self.errors += 1
+            else:
+                self.completed.append((now, n_records))
+            while self.completed and self.completed[0][0] < now - THROUGHPUT_WINDOW:
+                self.completed.popleft()
+
+    def snapshot(self, batch_sizes=()):
+        now = time.perf_counter()
+        with self.lock:
+            latencies = np.asarray(self.latencies) * 1000
+            recent = [(t, n) for t, n in self.completed if t >= now - THROUGHPUT_WINDOW]
+            requests = self.requests
+            errors = self.errors
+        window = min(THROUGHPUT_WINDOW, now - recent[0][0]) if recent else 0.0
+        return {
+            "requests": requests,
+            "errors": errors,
+            "latency_ms_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "latency_ms_p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "requests_per_second": len(recent) / window if window > 0 else 0.0,
+            "records_per_second": sum(n for _, n in recent) / window if window > 0 else 0.0,
+            "mean_batch_requests": float(np.mean(batch_sizes)) if len(batch_sizes) else None,
+        }
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    # the ScoringServer below provides .batcher and .metrics
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self._send(200, self.server.metrics.snapshot(list(self.server.batcher.batch_sizes)))
+        else:
+            self._send(404, {"error": f"no route {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._send(404, {"error": f"no route {self.path}"})
+            return
+        start = time.perf_counter()
+        status, response, n_records = self._score()
+        self._send(status, response)
+        self.server.metrics.record(time.perf_counter() - start, n_records, failed=status != 200)
+
+    def _score(self):
+        # (status, response, records scored)
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as e:
+            return 400, {"error": f"invalid JSON: {e}"}, 0
+
+        single = isinstance(body, dict) and "records" not in body
+        records = [body] if single else body.get("records") if isinstance(body, dict) else body
+        if not isinstance(records, list) or not records or not all(isinstance(r, dict) for r in records):
+            return 400, {"error": "expected a loan record, a list of them, or {\"records\": [...]}"}, 0
+        max_records = self.server.batcher.max_records
+        if len(records) > max_records:
+            return 413, {"error": f"{len(records):,} records in one request, the limit is {max_records:,}"}, 0
+
+        try:
+            scores, predictions = self.server.batcher.submit(records).result()
+        except Exception as e:
+            return 500, {"error": f"{type(e).__name__}: {e}"}, 0
+
+        if single:
+            return 200, {"score": float(scores[0]), "prediction": int(predictions[0])}, 1
+        return 200, {"scores": scores.tolist(), "predictions": predictions.astype(int).tolist()}, len(records)
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # per-request logging would dominate the latency being measured
+
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, model_ref, max_batch=64, max_records=1024, max_wait=0.002):
+        self.batcher = MicroBatcher(ModelScorer(model_ref), max_batch=max_batch, max_records=max_records,
+                                    max_wait=max_wait)
+        self.metrics = ServiceMetrics()
+        super().__init__(address, ScoringHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a saved Custom Model Builder pipeline over HTTP.")
+    parser.add_argument("model", help="model artifact path or key, or a joblib file with a fitted pipeline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=64, help="most requests scored in one call (default 64)")
+    parser.add_argument("--max-records", type=int, default=1024,
+                        help="most records scored in one call, and in one request (default 1024)")
+    parser.add_argument("--max-wait-ms", type=float, default=2.0,
+                        help="how long the first request of a batch waits for others (default 2)")
+    args = parser.parse_args(argv)
+
+    server = ScoringServer((args.host, args.port), args.model, args.max_batch, args.max_records, args.max_wait_ms / 1000)
+    print(f"scoring on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
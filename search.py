@@ -0,0 +1,562 @@
+'''
+Running the Custom Model Builder's hyperparameter search.
+
+Every session on the server shares one WorkerBudget. A search asks it for
+workers and gets at most what is still free, so several users running
+searches at once cannot oversubscribe the machine.
+'''
+
+import functools
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import math
+
+import numpy as np
+import pandas as pd
+from joblib import Memory, parallel_backend
+from scipy.stats import norm, rankdata
+from sklearn.base import clone
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern, WhiteKernel
+from sklearn.model_selection import GridSearchCV, ParameterGrid, cross_validate
+from sklearn.utils import resample
+
+from scoring import REFIT_METRIC
+
+# total workers all sessions together may use; defaults to every core
+MAX_WORKERS = int(os.environ.get("LOAN_APP_MAX_WORKERS", os.cpu_count() or 1))
+
+# on-disk cache of fitted pipeline steps, trimmed to PIPELINE_CACHE_BYTES after each search
+PIPELINE_CACHE_DIR = os.environ.get("LOAN_APP_PIPELINE_CACHE", ".cache/pipeline")
+PIPELINE_CACHE_BYTES = int(os.environ.get("LOAN_APP_PIPELINE_CACHE_BYTES", 2 * 1024**3))
+
+# joblib backend name for each choice shown in the UI
+BACKENDS = {
+    "Processes": "loky",
+    "Threads": "threading",
+}
+
+
+class WorkerBudget:
+    """
+    Process-wide cap on search workers. reserve() blocks while every worker
+    is taken and otherwise grants min(requested, free workers).
+    """
+
+    def __init__(self, total=MAX_WORKERS):
+        self.total = max(1, int(total))
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, requested):
+        with self._cond:
+            while self.in_use >= self.total:
+                self._cond.wait()
+            granted = max(1, min(int(requested), self.total - self.in_use))
+            self.in_use += granted
+        try:
+            yield granted
+        finally:
+            with self._cond:
+                self.in_use -= granted
+                self._cond.notify_all()
+
+
+def run_search(search, X, y, budget, n_jobs=1, backend="loky"):
+    """
+    Fit a *SearchCV object with up to n_jobs workers from `budget`.
+    Returns (workers actually used, wall time in seconds).
+    """
+    with budget.reserve(n_jobs) as granted:
+        search.set_params(n_jobs=granted)
+        start = time.perf_counter()
+        with parallel_backend(backend, n_jobs=granted):
+            search.fit(X, y)
+        wall_time = time.perf_counter() - start
+    return granted, wall_time
+
+
+def fit_search(search, X, y, budget, n_jobs=1, backend="loky", pipeline_cache=None, oof=None):
+    """
+    Run a search end to end and package it as a SearchResult with its run
+    statistics. With `oof`, the OOFRecorder the search's scoring wrote to,
+    the diagnostics also get the best candidate's out-of-fold predictions,
+    aligned with X: oof_scores (float32, NaN where never scored), the
+    cutoff its predict() uses as oof_threshold, and oof_pred (int8: 1
+    flagged, 0 not, -1 never scored). The results view draws every
+    training-set diagnostic from these, with no predict over X.
+    """
+    try:
+        workers_used, wall_time = run_search(search, X, y, budget, n_jobs, backend)
+        oof_scores = oof.collect(search.best_params_, X.index) if oof is not None else None
+    finally:
+        if oof is not None:
+            oof.cleanup()
+        if pipeline_cache is not None:
+            cache_counts = pipeline_cache.counts()
+            pipeline_cache.trim()
+            pipeline_cache.close()
+        else:
+            cache_counts = {"hits": 0, "misses": 0}
+
+    info = {
+        "workers": workers_used,
+        "wall_time": wall_time,
+        "cache_hits": cache_counts["hits"],
+        "cache_misses": cache_counts["misses"],
+    }
+    # strategy-specific statistics, e.g. the compute successive halving saved
+    info.update(getattr(search, "info_", {}))
+    results = SearchResult.from_search(search, info=info)
+    if oof_scores is not None:
+        scores, threshold = oof_scores
+        results.diagnostics["oof_scores"] = scores
+        results.diagnostics["oof_threshold"] = threshold
+        results.diagnostics["oof_pred"] = np.where(np.isnan(scores), -1, scores > threshold).astype(np.int8)
+    return results
+
+
+def planned_fits(search, n_samples):
+    """Number of (candidate, fold) fits a search will score, for progress bars."""
+    if hasattr(search, "n_fits"):
+        return search.n_fits(n_samples)
+    return len(ParameterGrid(search.param_grid)) * search.cv.get_n_splits()
+
+
+def serial_time_estimate(cv_results):
+    """
+    Time the same search would have taken on one core: every fit and score
+    call in cv_results_ added up.
+    """
+    suffix = "_test_" + _first_metric(cv_results)
+    n_splits = sum(1 for key in cv_results if key.startswith("split") and key.endswith(suffix))
+    per_candidate = np.asarray(cv_results["mean_fit_time"]) + np.asarray(cv_results["mean_score_time"])
+    return float(per_candidate.sum() * n_splits)
+
+
+def _first_metric(cv_results):
+    # "profit" for loan_scorer, "score" for single-metric searches
+    for key in cv_results:
+        if key.startswith("mean_test_"):
+            return key[len("mean_test_"):]
+    raise KeyError("cv_results has no test scores")
+
+
+class PipelineCache:
+    """
+    joblib.Memory for Pipeline(memory=...) that also counts hits and misses.
+
+    Pipeline caches the output of every step but the classifier, keyed on the
+    step's parameters and its input, so within one fold a candidate that only
+    changes clf__C reuses the fitted ColumnTransformer and feature creation.
+    The counters are files that get one byte appended per event; that keeps
+    them correct when the fits run in worker processes.
+    """
+
+    def __init__(self, location=PIPELINE_CACHE_DIR, bytes_limit=PIPELINE_CACHE_BYTES):
+        self.location = location
+        self.bytes_limit = bytes_limit
+        self.memory = Memory(location, verbose=0)
+        self.tag = uuid.uuid4().hex
+        os.makedirs(self._counter_dir(), exist_ok=True)
+
+    def cache(self, func):
+        misses = self._counter_path("misses")
+        calls = self._counter_path("calls")
+
+        # only runs when joblib has no stored result
+        @functools.wraps(func)
+        def counted(*args, **kwargs):
+            _bump(misses)
+            return func(*args, **kwargs)
+
+        cached = self.memory.cache(counted)
+
+        def call(*args, **kwargs):
+            _bump(calls)
+            return cached(*args, **kwargs)
+
+        return call
+
+    def counts(self):
+        calls = _read_count(self._counter_path("calls"))
+        misses = _read_count(self._counter_path("misses"))
+        return {"hits": calls - misses, "misses": misses}
+
+    def trim(self):
+        # joblib drops the least recently accessed results first
+        self.memory.reduce_size(bytes_limit=self.bytes_limit)
+
+    def close(self):
+        # counters are per search; the cached results stay for the next one
+        for name in ("calls", "misses"):
+            path = self._counter_path(name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _counter_dir(self):
+        return os.path.join(self.location, "counters")
+
+    def _counter_path(self, name):
+        return os.path.join(self._counter_dir(), f"{self.tag}.{name}")
+
+
+def _bump(path):
+    # O_APPEND writes of one byte are atomic, so processes can share the file
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    try:
+        os.write(fd, b".")
+    finally:
+        os.close(fd)
+
+
+def _read_count(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class SearchResult:
+    """
+    What the results view needs from a finished search, detached from the
+    search object so it can be stored and reloaded (see experiment_cache.py).
+
+    `info` holds run statistics (wall time, workers, cache counts) and
+    `diagnostics` holds arrays the results view would otherwise recompute.
+    """
+
+    def __init__(self, cv_results, best_estimator, best_index, info=None, diagnostics=None):
+        self.cv_results_ = cv_results
+        self.best_estimator_ = best_estimator
+        self.best_index_ = best_index
+        self.best_params_ = cv_results["params"][best_index]
+        self.info = info or {}
+        self.diagnostics = diagnostics or {}
+
+    @classmethod
+    def from_search(cls, search, **kwargs):
+        best_estimator = search.best_estimator_
+        # the pipeline cache lives on this server only
+        if "memory" in best_estimator.get_params(deep=False):
+            best_estimator.set_params(memory=None)
+        return cls(search.cv_results_, best_estimator, search.best_index_, **kwargs)
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+def _halvings(n, factor, unit=1):
+    # largest k with unit * factor**k <= n, in integers: math.log(243, 3) is 4.999...
+    k = 0
+    while unit * factor ** (k + 1) <= n:
+        k += 1
+    return k
+
+
+def halving_schedule(n_candidates, n_samples, factor=3, min_resources=2000):
+    """
+    (candidates, training rows) for each rung of successive halving. The last
+    rung always uses every row; earlier rungs shrink by `factor` while the
+    candidate count grows by it. min_resources is a floor, not the first
+    rung's size: counting back from all rows, the first rung gets between
+    min_resources and factor * min_resources rows.
+    """
+    n_rungs = 1 + min(_halvings(max(n_candidates, 1), factor), _halvings(n_samples, factor, min_resources))
+
+    schedule = []
+    for rung in range(n_rungs):
+        rows = n_samples // factor ** (n_rungs - 1 - rung)
+        schedule.append((n_candidates, rows))
+        n_candidates = max(1, int(math.ceil(n_candidates / factor)))
+    return schedule
+
+
+class HalvingSearch:
+    """
+    Successive halving over the candidates of a GridSearchCV param grid.
+
+    Every candidate is cross-validated on a small stratified subsample of
+    the training rows; the best 1/factor (by the refit metric) move on to a
+    subsample `factor` times larger, until the survivors are scored on all
+    rows and the best one is refit. Each rung is an ordinary GridSearchCV,
+    so any scoring GridSearchCV accepts works here. cv_results_ stacks the
+    rungs, with their `iter` and `n_resources`.
+    """
+
+    def __init__(self, estimator, param_grid, cv, scoring, refit=REFIT_METRIC, factor=3,
+                 min_resources=2000, random_state=0, n_jobs=None, error_score="raise"):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.refit = refit
+        self.factor = factor
+        self.min_resources = min_resources
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.error_score = error_score
+
+    def set_params(self, **params):
+        for name, value in params.items():
+            setattr(self, name, value)
+        return self
+
+    def fit(self, X, y):
+        candidates = list(ParameterGrid(self.param_grid))
+        schedule = halving_schedule(len(candidates), len(y), self.factor, self.min_resources)
+
+        rung_results = []
+        offset = 0
+        for rung, (_, n_rows) in enumerate(schedule):
+            if n_rows < len(y):
+                rows = resample(np.arange(len(y)), replace=False, n_samples=n_rows,
+                                stratify=y, random_state=self.random_state + rung)
+            else:
+                rows = np.arange(len(y))
+
+            last = rung == len(schedule) - 1
+            search = GridSearchCV(
+                self.estimator,
+                # one single-valued grid per candidate keeps exactly these candidates
+                [{name: [value] for name, value in params.items()} for params in candidates],
+                cv=self.cv,
+                scoring=self.scoring,
+                refit=self.refit if last else False,
+                n_jobs=self.n_jobs,
+                error_score=self.error_score,
+            )
+            search.fit(X.iloc[rows], y.iloc[rows])
+
+            rung_df = pd.DataFrame(search.cv_results_)
+            rung_df.insert(0, "n_resources", n_rows)
+            rung_df.insert(0, "iter", rung)
+            rung_results.append(rung_df)
+
+            if last:
+                self.best_index_ = offset + search.best_index_
+                self.best_estimator_ = search.best_estimator_
+            else:
+                offset += len(candidates)
+                scores = search.cv_results_[f"mean_test_{self.refit}"]
+                keep = max(1, int(math.ceil(len(candidates) / self.factor)))
+                order = np.argsort(-scores, kind="stable")[:keep]
+                candidates = [candidates[i] for i in order]
+
+        cv_results = pd.concat(rung_results, ignore_index=True)
+        self.cv_results_ = {col: cv_results[col].to_numpy() for col in cv_results.columns}
+        self.best_params_ = self.cv_results_["params"][self.best_index_]
+
+        # compute relative to the full grid, in candidate-rows fitted
+        full = schedule[0][0] * len(y)
+        used = sum(n * rows for n, rows in schedule)
+        self.info_ = {"compute_fraction": used / full}
+        return self
+
+    def n_fits(self, n_samples):
+        """Cross-validation fits the search will run on n_samples rows."""
+        n_candidates = len(ParameterGrid(self.param_grid))
+        schedule = halving_schedule(n_candidates, n_samples, self.factor, self.min_resources)
+        return sum(n for n, _ in schedule) * self.cv.get_n_splits()
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+def build_cv_results(candidates, fold_scores, fit_times, score_times):
+    """
+    cv_results_ in GridSearchCV's layout for searches that evaluate candidates
+    themselves. fold_scores maps each metric to an (n_candidates, n_splits)
+    array; fit_times and score_times have the same shape.
+    """
+    fit_times = np.asarray(fit_times, dtype=float)
+    score_times = np.asarray(score_times, dtype=float)
+    results = {
+        "mean_fit_time": fit_times.mean(axis=1),
+        "std_fit_time": fit_times.std(axis=1),
+        "mean_score_time": score_times.mean(axis=1),
+        "std_score_time": score_times.std(axis=1),
+    }
+
+    for name in sorted({name for params in candidates for name in params}):
+        column = np.ma.MaskedArray(np.empty(len(candidates), dtype=object), mask=True)
+        for i, params in enumerate(candidates):
+            if name in params:
+                column[i] = params[name]
+        results[f"param_{name}"] = column
+    results["params"] = list(candidates)
+
+    for metric, scores in fold_scores.items():
+        scores = np.asarray(scores, dtype=float)
+        for split in range(scores.shape[1]):
+            results[f"split{split}_test_{metric}"] = scores[:, split]
+        results[f"mean_test_{metric}"] = scores.mean(axis=1)
+        results[f"std_test_{metric}"] = scores.std(axis=1)
+        # unscored candidates (NaN) rank last, as in GridSearchCV
+        means = np.nan_to_num(scores.mean(axis=1), nan=-np.inf)
+        results[f"rank_test_{metric}"] = rankdata(-means, method="min").astype(np.int32)
+    return results
+
+
+class ParamSpace:
+    """
+    The ranges behind a construct_param_grid grid. Float parameters (C,
+    threshold) are sampled uniformly between the grid's min and max; integer
+    parameters (k, n_neighbors, ...) are drawn from the grid's own values so
+    step sizes are respected.
+    """
+
+    def __init__(self, param_grid):
+        self.names = sorted(param_grid)
+        self.values = {name: np.asarray(param_grid[name]) for name in self.names}
+
+    def _is_float(self, name):
+        return np.issubdtype(self.values[name].dtype, np.floating)
+
+    def sample(self, rng):
+        params = {}
+        for name in self.names:
+            values = self.values[name]
+            if self._is_float(name):
+                params[name] = float(rng.uniform(values.min(), values.max()))
+            else:
+                params[name] = values[rng.integers(len(values))].item()
+        return params
+
+    def encode(self, params):
+        # position of each value within its range, for the surrogate model
+        point = []
+        for name in self.names:
+            values = self.values[name]
+            if not np.issubdtype(values.dtype, np.number):
+                point.append(float(np.flatnonzero(values == params[name])[0]) / max(len(values) - 1, 1))
+                continue
+            low, high = float(values.min()), float(values.max())
+            point.append((params[name] - low) / (high - low) if high > low else 0.0)
+        return point
+
+    def n_discrete(self):
+        """Number of distinct candidates, or None if any parameter is continuous."""
+        if any(self._is_float(name) for name in self.names):
+            return None
+        return int(np.prod([len(np.unique(self.values[name])) for name in self.names]))
+
+
+class BudgetedSearch:
+    """
+    Samples candidates from the param grid's ranges until a wall-clock
+    budget (seconds) or a budget of candidates runs out, then refits the
+    best one found.
+
+    method="random" samples uniformly. method="model" starts with
+    `n_initial` random candidates and then picks each next candidate by
+    expected improvement under a Gaussian process fitted to the profit
+    scores so far. The budget is checked before each new candidate, so the
+    last one may run past it. Without max_candidates the search scores at
+    most as many candidates as the grid has points, so n_fits() is a real
+    upper bound. info_["trace"] records (elapsed seconds, best profit so
+    far) after every candidate.
+    """
+
+    def __init__(self, estimator, param_grid, cv, scoring, refit=REFIT_METRIC, method="random",
+                 time_budget=60, max_candidates=None, n_initial=5, n_pool=500, random_state=0,
+                 n_jobs=None, error_score="raise"):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.refit = refit
+        self.method = method
+        self.time_budget = time_budget
+        self.max_candidates = max_candidates
+        self.n_initial = n_initial
+        self.n_pool = n_pool
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.error_score = error_score
+
+    def set_params(self, **params):
+        for name, value in params.items():
+            setattr(self, name, value)
+        return self
+
+    def _next_candidate(self, space, rng, candidates, scores, seen):
+        if self.method != "model" or len(candidates) < self.n_initial:
+            return space.sample(rng)
+
+        gp = GaussianProcessRegressor(kernel=Matern(nu=2.5) + WhiteKernel(), normalize_y=True,
+                                      random_state=self.random_state)
+        gp.fit(np.array([space.encode(c) for c in candidates]), np.array(scores))
+
+        pool = [space.sample(rng) for _ in range(self.n_pool)]
+        pool = [c for c in pool if _params_key(c) not in seen]
+        if not pool:
+            return None  # the sampled space is exhausted
+        mean, std = gp.predict(np.array([space.encode(c) for c in pool]), return_std=True)
+        std = np.maximum(std, 1e-12)
+        z = (mean - max(scores)) / std
+        expected_improvement = (mean - max(scores)) * norm.cdf(z) + std * norm.pdf(z)
+        return pool[int(np.argmax(expected_improvement))]
+
+    def fit(self, X, y):
+        space = ParamSpace(self.param_grid)
+        n_discrete = space.n_discrete()
+        max_candidates = self._max_candidates()
+        rng = np.random.default_rng(self.random_state)
+
+        candidates, seen, profit = [], set(), []
+        fold_scores, fit_times, score_times = {}, [], []
+        trace = []
+        start = time.perf_counter()
+        while True:
+            # always score at least one candidate
+            out_of_budget = (
+                time.perf_counter() - start >= self.time_budget
+                or len(candidates) >= max_candidates
+            )
+            if candidates and out_of_budget:
+                break
+            if n_discrete is not None and len(seen) >= n_discrete:
+                break  # every grid point has been scored
+
+            params = self._next_candidate(space, rng, candidates, profit, seen)
+            if params is None:
+                break
+            if _params_key(params) in seen:
+                continue
+            seen.add(_params_key(params))
+
+            estimator = clone(self.estimator).set_params(**params)
+            out = cross_validate(estimator, X, y, cv=self.cv, scoring=self.scoring,
+                                 n_jobs=self.n_jobs, error_score=self.error_score)
+            candidates.append(params)
+            fit_times.append(out["fit_time"])
+            score_times.append(out["score_time"])
+            for key, values in out.items():
+                if key.startswith("test_"):
+                    fold_scores.setdefault(key[len("test_"):], []).append(values)
+            profit.append(float(np.mean(out[f"test_{self.refit}"])))
+            trace.append((time.perf_counter() - start, max(profit)))
+
+        self.cv_results_ = build_cv_results(candidates, fold_scores, fit_times, score_times)
+        self.best_index_ = int(np.argmax(profit))
+        self.best_params_ = candidates[self.best_index_]
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(X, y)
+        self.info_ = {"trace": trace, "n_candidates": len(candidates)}
+        return self
+
+    def _max_candidates(self):
+        return self.max_candidates or ParamSpace(self.param_grid).n_discrete() or len(ParameterGrid(self.param_grid))
+
+    def n_fits(self, n_samples):
+        # an upper bound: the budget usually stops the search earlier
+        return self._max_candidates() * self.cv.get_n_splits()
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+def _params_key(params):
+    return tuple(sorted(params.items()))